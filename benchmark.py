@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import time
+import calendar
+import datetime
+import json
+import json5
+import sqlite3
+import ssl
+import bisect
+import hashlib
+import base64
+import random
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import parse
+from typing import List, Dict
+
+from dateutil import parser as DateParser
+
+import argparse
+import logging
+
+XSSI_PREFIX = b")]}'\n"
+
+# bits of ListChangesOption, see Gerrit.CHANGE_OPTIONS
+OPTION_CURRENT_FILES = 5
+OPTION_DETAILED_ACCOUNTS = 7
+
+
+def epoch(text: str):
+    # same interpretation as Gerrit.time_epoch: the zone is ignored
+    tm = DateParser.parse(text).replace(tzinfo=datetime.timezone.utc)
+    return calendar.timegm(tm.utctimetuple())
+
+
+def gerrit_time(seconds: int):
+    return time.strftime('%Y-%m-%d %H:%M:%S.000000000', time.gmtime(seconds))
+
+
+def revision(number: int):
+    return hashlib.sha1(b'%d' % (number)).hexdigest()
+
+
+class SyntheticHistory:
+    # compact change records, rendered to gerrit json on demand
+    NUMBER = 0
+    PROJECT = 1
+    BRANCH = 2
+    ORIGIN = 3
+    UPDATED = 4
+    PARENT = 5
+    STATUS = 6
+
+    projects: List[str] = None
+    changes: List[tuple] = None
+    branches: Dict[str, Dict] = None
+    by_branch: Dict[tuple, List[tuple]] = None
+    by_origin: Dict[int, List[tuple]] = None
+    # Change-Id(as an origin) of the changes picked with another one
+    aliases: Dict[int, int] = None
+
+    def __init__(self,
+                 branch_config: Dict[str, Dict],
+                 changes: int = 10000,
+                 projects: int = 1,
+                 pick_ratio: float = 0.3,
+                 abandon_ratio: float = 0.02,
+                 span_days: int = 365,
+                 seed: int = 1):
+        self.projects = ['bench/p%d' % (index) for index in range(max(1, projects))]
+        self.branches = self.__load_branches(branch_config)
+        self.changes = []
+        self.by_branch = {}
+        self.by_origin = {}
+        self.aliases = {}
+
+        rng = random.Random(seed)
+        per_project = max(1, changes // len(self.projects))
+        start = min([item['time'] for item in self.branches.values()])
+        end = max([item['time'] for item in self.branches.values()]) + span_days * 86400
+        step = max(1, (end - start) // per_project)
+        for project in self.projects:
+            self.__generate(rng, project, per_project, start, step,
+                            pick_ratio, abandon_ratio)
+
+        for chg in self.changes:
+            self.by_branch.setdefault((chg[self.PROJECT], chg[self.BRANCH]), []).append(chg)
+            self.by_origin.setdefault(chg[self.ORIGIN], []).append(chg)
+
+    def __load_branches(self, branch_config: Dict[str, Dict]):
+        # branches whose create time can not be parsed are left out together
+        # with their children
+        branches = {}
+        pending = dict(branch_config)
+        while True:
+            added = False
+            for name, item in list(pending.items()):
+                if item['parent'] != '' and item['parent'] not in branches:
+                    continue
+                del pending[name]
+                try:
+                    created = epoch(item['create_time'])
+                except (ValueError, OverflowError):
+                    logging.warning('Skip branch %s: bad create_time %s' %
+                                    (name, item['create_time']))
+                    continue
+                branches[name] = {'parent': item['parent'], 'time': created}
+                added = True
+            if not added:
+                break
+        for name in pending:
+            logging.warning('Skip branch %s: missing parent' % (name))
+        if len(branches) == 0:
+            raise RuntimeError('No usable branch in branch config')
+        return branches
+
+    def __generate(self, rng: random.Random, project: str, count: int,
+                   start: int, step: int, pick_ratio: float,
+                   abandon_ratio: float):
+        created = sorted(self.branches.items(), key=lambda item: item[1]['time'])
+        heads = {}
+        # merged changes of the parent branch not yet picked, per branch
+        candidates = {}
+        opened = []
+        for index in range(count):
+            now = start + index * step
+            while len(created) > 0 and created[0][1]['time'] <= now:
+                name, item = created.pop(0)
+                heads[name] = heads.get(item['parent'], 0)
+                candidates[name] = []
+                opened.append(name)
+            if len(opened) == 0:
+                continue
+
+            branch = rng.choice(opened)
+            number = len(self.changes) + 1
+            origin = number
+            picks = candidates[branch]
+            if len(picks) > 0 and rng.random() < pick_ratio:
+                origin = picks.pop(rng.randrange(max(0, len(picks) - 50), len(picks)))
+
+            status = 'MERGED'
+            if rng.random() < abandon_ratio:
+                status = 'ABANDONED'
+            self.changes.append((number, project, branch, origin, now,
+                                 heads[branch], status))
+            if status != 'MERGED':
+                continue
+
+            heads[branch] = number
+            if origin == number:
+                for name in opened:
+                    if self.branches[name]['parent'] == branch:
+                        candidates[name].append(number)
+
+    def repick(self, number: int, alias: int):
+        # the change was picked with the Change-Id of `alias`, its patch is
+        # still the one of its origin
+        chg = self.changes[number - 1]
+        self.by_origin[self.aliases.get(number, chg[self.ORIGIN])].remove(chg)
+        self.by_origin.setdefault(alias, []).append(chg)
+        self.aliases[number] = alias
+
+    def patch(self, chg: tuple):
+        # format-patch of the change, every pick of an origin has the same
+        # diff at other line numbers
+        number = chg[self.NUMBER]
+        origin = chg[self.ORIGIN]
+        path = 'src/file%d.c' % (origin % 13)
+        line = number % 50 + 1
+        return ('From %s Mon Sep 17 00:00:00 2001\n'
+                'Subject: [PATCH] Synthetic change %d\n\n---\n'
+                'diff --git a/%s b/%s\nindex %s..%s 100644\n--- a/%s\n+++ b/%s\n'
+                '@@ -%d,2 +%d,3 @@\n context\n+line %d\n context\n') % (
+                    revision(number), origin, path, path, revision(number)[:7],
+                    revision(chg[self.PARENT])[:7], path, path, line, line, origin)
+
+    def render(self, chg: tuple, mask: int = 0):
+        number = chg[self.NUMBER]
+        project = chg[self.PROJECT]
+        branch = chg[self.BRANCH]
+        change_id = 'I%040x' % (self.aliases.get(number, chg[self.ORIGIN]))
+        updated = gerrit_time(chg[self.UPDATED])
+        rev = revision(number)
+        author = {'name': 'Author %d' % (number % 97),
+                  'email': 'author%d@example.com' % (number % 97),
+                  'date': updated}
+        commit = {
+            'parents': [{'commit': revision(chg[self.PARENT]) if chg[self.PARENT] else '0' * 40}],
+            'author': author,
+            'committer': dict(author, name='Gerrit Code Review'),
+            'subject': 'Synthetic change %d' % (chg[self.ORIGIN]),
+            'message': 'Synthetic change %d\n\nChange-Id: %s\n' % (chg[self.ORIGIN], change_id),
+        }
+        current = {'kind': 'REWORK', '_number': 1, 'ref': 'refs/changes/%02d/%d/1' % (number % 100, number),
+                   'commit': commit}
+        if mask & (1 << OPTION_CURRENT_FILES):
+            current['files'] = {'src/file%d.c' % (number % 13): {'lines_inserted': number % 17 + 1}}
+        owner = {'_account_id': 1000000 + number % 97}
+        if mask & (1 << OPTION_DETAILED_ACCOUNTS):
+            owner.update(name=author['name'], email=author['email'])
+        return {
+            'id': '%s~%s~%s' % (parse.quote(project, safe=''), branch, change_id),
+            'project': project,
+            'branch': branch,
+            'change_id': change_id,
+            'subject': commit['subject'],
+            'status': chg[self.STATUS],
+            'created': updated,
+            'updated': updated,
+            'submitted': updated,
+            'owner': owner,
+            '_number': number,
+            'current_revision': rev,
+            'revisions': {rev: current},
+        }
+
+    def lookup(self, id: str):
+        # change number, Change-Id or project~branch~Change-Id
+        if id.isdigit():
+            number = int(id)
+            if 0 < number <= len(self.changes):
+                return [self.changes[number - 1]]
+            return []
+        parts = parse.unquote(id).split('~')
+        match = re.match(r'^I([0-9a-f]{40})$', parts[-1])
+        if match is None:
+            return []
+        res = self.by_origin.get(int(match.group(1), 16), [])
+        if len(parts) == 3:
+            res = [chg for chg in res
+                   if chg[self.PROJECT] == parts[0] and chg[self.BRANCH] == parts[1]]
+        return res
+
+    def query(self, q: str):
+        # the subset of the search syntax sent by gerrit.py
+        terms = re.findall(r'\(|\)|-?[\w.]+:"[^"]*"|[^\s()]+', q)
+        ids = []
+        filters = []
+        project = None
+        branch = None
+        since = None
+        until = None
+        for term in terms:
+            if term in ['(', ')', 'OR']:
+                continue
+            negate = term.startswith('-')
+            key, _, value = term.lstrip('-').partition(':')
+            value = value.strip('"')
+            if key == 'change' and not negate:
+                ids.append(value)
+            elif key == 'change':
+                filters.append(lambda chg, value=value: not self.__is_change(chg, value))
+            elif key in ['is', 'status']:
+                status = {'merged': 'MERGED', 'abandoned': 'ABANDONED',
+                          'open': 'NEW', 'new': 'NEW'}.get(value, value.upper())
+                filters.append(lambda chg, status=status, negate=negate:
+                               (chg[self.STATUS] == status) != negate)
+            elif key == 'project':
+                project = value
+            elif key == 'branch':
+                branch = value
+            elif key in ['since', 'after']:
+                since = epoch(value)
+            elif key in ['until', 'before']:
+                until = epoch(value)
+
+        if len(ids) > 0:
+            res = {}
+            for id in ids:
+                for chg in self.lookup(id):
+                    res[chg[self.NUMBER]] = chg
+            res = sorted(res.values(), key=lambda chg: chg[self.UPDATED])
+        elif project is not None and branch is not None:
+            res = self.by_branch.get((project, branch), [])
+        else:
+            res = self.changes
+
+        # changes are kept in time order, so a range is a slice
+        times = [chg[self.UPDATED] for chg in res] if since or until else None
+        if since is not None:
+            res = res[bisect.bisect_left(times, since):]
+            times = times[len(times) - len(res):]
+        if until is not None:
+            res = res[:bisect.bisect_right(times, until)]
+
+        if project is not None:
+            filters.append(lambda chg: chg[self.PROJECT] == project)
+        if branch is not None:
+            filters.append(lambda chg: chg[self.BRANCH] == branch)
+        return [chg for chg in reversed(res)
+                if all([accept(chg) for accept in filters])]
+
+    def __is_change(self, chg: tuple, id: str):
+        if id.isdigit():
+            return chg[self.NUMBER] == int(id)
+        return chg in self.lookup(id)
+
+
+class StubGerrit:
+    history: SyntheticHistory = None
+    latency: float = None
+    page_limit: int = None
+    # drop(path, body) gives how much of the body is sent before the
+    # connection is dropped, None sends all of it
+    drop = None
+    requests: int = None
+    bytes: int = None
+    host: str = None
+
+    def __init__(self,
+                 history: SyntheticHistory,
+                 cert: str,
+                 key: str,
+                 latency: float = 0,
+                 page_limit: int = 500,
+                 port: int = 0):
+        self.history = history
+        self.latency = latency
+        self.page_limit = page_limit
+        self.__lock = threading.Lock()
+        self.reset()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def do_GET(self):
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+                status, body, headers = stub.handle(self.path, self.headers)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                cut = stub.drop(self.path, body) if stub.drop is not None else None
+                if cut is not None:
+                    self.wfile.write(body[:cut])
+                    self.close_connection = True
+                    stub.count(cut)
+                    return
+                self.wfile.write(body)
+                stub.count(len(body))
+
+        self.server = ThreadingHTTPServer(('localhost', port), Handler)
+        self.server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.host = 'localhost:%d' % (self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.__lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def count(self, size: int):
+        with self.__lock:
+            self.requests += 1
+            self.bytes += size
+
+    def handle(self, path: str, headers):
+        url = parse.urlsplit(path)
+        qs = parse.parse_qs(url.query)
+        route = url.path[2:] if url.path.startswith('/a/') else url.path
+
+        if route == '/projects/':
+            prefix = qs.get('p', [''])[0]
+            return self.__reply({name: {'id': parse.quote(name, safe=''), 'state': 'ACTIVE'}
+                                 for name in self.history.projects
+                                 if name.startswith(prefix)})
+
+        if route == '/changes/':
+            mask = int(qs.get('O', ['0'])[0], 16)
+            start = int(qs.get('S', ['0'])[0])
+            limit = min(int(qs.get('n', [str(self.page_limit)])[0]), self.page_limit)
+            res = self.history.query(qs.get('q', [''])[0])
+            page = [self.history.render(chg, mask) for chg in res[start:start + limit]]
+            if len(page) > 0 and len(res) > start + len(page):
+                page[-1]['_more_changes'] = True
+            return self.__reply(page)
+
+        match = re.match(r'^/changes/([^/]+)/revisions/[^/]+/patch$', route)
+        if match is not None:
+            res = self.history.lookup(match.group(1))
+            if len(res) == 0:
+                return 404, b'Not found\n', {}
+            return 200, base64.b64encode(self.history.patch(res[0]).encode()), {}
+
+        match = re.match(r'^/changes/([^/]+)(/detail)?/?$', route)
+        if match is not None:
+            res = self.history.lookup(match.group(1))
+            if len(res) == 0:
+                return 404, b'Not found\n', {}
+            chg = res[0]
+            etag = '"%d-%d"' % (chg[SyntheticHistory.NUMBER], chg[SyntheticHistory.UPDATED])
+            if headers.get('If-None-Match') == etag:
+                return 304, b'', {'ETag': etag}
+            return self.__reply(self.history.render(chg), {'ETag': etag})
+
+        return 404, b'Not found\n', {}
+
+    def __reply(self, obj, headers: Dict[str, str] = {}):
+        return 200, XSSI_PREFIX + json.dumps(obj).encode(), headers
+
+
+class Benchmark:
+    SCENARIOS = ['update-cache', 'cherry-pick-list', 'cherry-pick-list-warm',
+                 'cherry-pick-list-only-cache']
+
+    stub: StubGerrit = None
+    workdir: str = None
+    branch_conf: str = None
+    gerrit_args: List[str] = None
+
+    def __init__(self, stub: StubGerrit, workdir: str, branch_conf: str,
+                 gerrit_args: List[str] = []):
+        self.stub = stub
+        self.workdir = workdir
+        self.branch_conf = branch_conf
+        self.gerrit_args = gerrit_args
+        self.conf = os.path.join(workdir, 'gerrit.json5')
+        with open(self.conf, 'w') as f:
+            json.dump({'host': stub.host, 'user': 'bench', 'passwd': 'bench',
+                       'insecure': True}, f)
+
+    def run(self, name: str, command: List[str], cache: str, options: List[str] = []):
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'gerrit.py')
+        args = [sys.executable, script, '-c', self.conf, '-b', self.branch_conf,
+                '-C', cache, '--response_cache', cache + '.response'] + \
+            self.gerrit_args + options + command
+        logging.info('%s: %s' % (name, ' '.join(command)))
+
+        rows = self.__count_rows(cache)
+        self.stub.reset()
+        stdout = open(os.path.join(self.workdir, '%s.md' % (name)), 'w')
+        stderr = open(os.path.join(self.workdir, '%s.log' % (name)), 'w')
+        start = time.perf_counter()
+        proc = subprocess.Popen(args, stdout=stdout, stderr=stderr)
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.perf_counter() - start
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        stdout.close()
+        stderr.close()
+        rows = self.__count_rows(cache) - rows
+
+        if proc.returncode != 0:
+            logging.error('%s failed(%d), see %s' % (name, proc.returncode, stderr.name))
+        return {
+            'name': name,
+            'returncode': proc.returncode,
+            'wall_time': round(wall, 3),
+            'cpu_time': round(usage.ru_utime + usage.ru_stime, 3),
+            'requests': self.stub.requests,
+            'bytes': self.stub.bytes,
+            'peak_rss_kb': usage.ru_maxrss,
+            'cache_rows': rows,
+            'cache_rows_per_sec': round(rows / wall, 1) if wall > 0 else 0,
+            'output_lines': self.__count_lines(stdout.name),
+        }
+
+    def run_all(self, scenarios: List[str], projects: List[str], branch: str,
+                branch_to: str):
+        results = []
+        cache = os.path.join(self.workdir, 'cache.db')
+        cold = os.path.join(self.workdir, 'cold.db')
+        for name in scenarios:
+            if name == 'update-cache':
+                results.append(self.run(name, ['update-cache', ','.join(projects), '*'], cache))
+            elif name == 'cherry-pick-list':
+                results.append(self.run(name, ['cherry-pick-list', projects[0], branch, branch_to], cold))
+            elif name == 'cherry-pick-list-warm':
+                results.append(self.run(name, ['cherry-pick-list', projects[0], branch, branch_to], cache))
+            elif name == 'cherry-pick-list-only-cache':
+                results.append(self.run(name, ['cherry-pick-list', projects[0], branch, branch_to], cache,
+                                        ['--only_cache']))
+            else:
+                raise RuntimeError('Unknown scenario: %s' % (name))
+        return results
+
+    @staticmethod
+    def __count_rows(cache: str):
+        if not os.path.exists(cache):
+            return 0
+        conn = sqlite3.connect('file:%s?mode=ro' % (parse.quote(cache)), uri=True)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM "tbl_changes"').fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+
+    @staticmethod
+    def __count_lines(path: str):
+        with open(path) as f:
+            return sum(1 for _ in f)
+
+
+def version():
+    # identifies the code under test in the results
+    path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(path, 'gerrit.py'), 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=path,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return {'commit': commit, 'gerrit_py_sha1': digest}
+
+
+def make_certificate(workdir: str):
+    cert = os.path.join(workdir, 'cert.pem')
+    key = os.path.join(workdir, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def compare(results: List[Dict], baseline: str, threshold: float):
+    with open(baseline) as f:
+        old = {item['name']: item for item in json.load(f)['results']}
+    regressions = 0
+    for item in results:
+        if item['name'] not in old:
+            continue
+        for metric in ['wall_time', 'requests', 'bytes', 'peak_rss_kb']:
+            before = old[item['name']][metric]
+            after = item[metric]
+            if before > 0 and after > before * (1 + threshold):
+                regressions += 1
+                logging.warning('%s %s: %s -> %s(+%.0f%%)' %
+                                (item['name'], metric, before, after,
+                                 (after / before - 1) * 100))
+    return regressions
+
+
+if __name__ == "__main__":
+    path = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser(add_help=True,
+                                     description='Benchmark gerrit.py against a synthetic gerrit server')
+    parser.add_argument('-b', '--branch_conf',
+                        help='Branch config of the synthetic history(default: config/branch.json5)',
+                        default=os.path.join(path, 'config', 'branch.json5'))
+    parser.add_argument('-n', '--changes', type=int,
+                        help='Number of synthetic changes(default: 10000)', default=10000)
+    parser.add_argument('--projects', type=int,
+                        help='Number of synthetic projects(default: 1)', default=1)
+    parser.add_argument('--pick_ratio', type=float,
+                        help='Ratio of the changes cherry-picked from the parent branch(default: 0.3)',
+                        default=0.3)
+    parser.add_argument('--abandon_ratio', type=float,
+                        help='Ratio of abandoned changes(default: 0.02)', default=0.02)
+    parser.add_argument('--seed', type=int, help='Random seed(default: 1)', default=1)
+    parser.add_argument('--latency', type=float,
+                        help='Milliseconds added to every response(default: 0)', default=0)
+    parser.add_argument('--page_limit', type=int,
+                        help='Most changes returned per query page(default: 500)', default=500)
+    parser.add_argument('--branch', help='Source branch(default: the root branch)')
+    parser.add_argument('--branch_to', help='Target branch(default: the first child of the source)')
+    parser.add_argument('-s', '--scenarios',
+                        help='Scenarios separated by comma(default: %s)' % (','.join(Benchmark.SCENARIOS)),
+                        default=','.join(Benchmark.SCENARIOS))
+    parser.add_argument('-o', '--out', help='Results file(default: benchmark.json)',
+                        default='benchmark.json')
+    parser.add_argument('--baseline', help='Results file to compare with')
+    parser.add_argument('--threshold', type=float,
+                        help='Relative increase reported as a regression(default: 0.1)', default=0.1)
+    parser.add_argument('--cert', help='Certificate of the stub server(default: self-signed)')
+    parser.add_argument('--key', help='Private key of the stub server')
+    parser.add_argument('--workdir', help='Keep databases, reports and logs in this directory')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Only run the stub server on PORT')
+    parser.add_argument('-V', '--verbose', action='store_true', help='Show debug log')
+    parser.add_argument('gerrit_args', nargs=argparse.REMAINDER,
+                        help='Extra options of gerrit.py after --')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='[%(levelname)-5.5s] %(message)s')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gerrit-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    with open(args.branch_conf) as f:
+        branch_config = json5.load(f)
+
+    start = time.perf_counter()
+    history = SyntheticHistory(branch_config, args.changes, args.projects,
+                               args.pick_ratio, args.abandon_ratio, seed=args.seed)
+    logging.info('Generated %d changes on %d branches in %.1fs' %
+                  (len(history.changes), len(history.branches), time.perf_counter() - start))
+
+    if args.cert:
+        cert, key = args.cert, args.key
+    else:
+        cert, key = make_certificate(workdir)
+    stub = StubGerrit(history, cert, key, args.latency / 1000, args.page_limit,
+                      args.serve or 0).start()
+
+    if args.serve:
+        logging.info('Serving on %s' % (stub.host))
+        try:
+            stub.thread.join()
+        except KeyboardInterrupt:
+            pass
+        stub.stop()
+        sys.exit(0)
+
+    branch = args.branch
+    if branch is None:
+        branch = [name for name, item in history.branches.items() if item['parent'] == ''][0]
+    branch_to = args.branch_to
+    if branch_to is None:
+        children = [name for name, item in history.branches.items() if item['parent'] == branch]
+        if len(children) == 0:
+            print('Missing argument: branch_to', file=sys.stderr)
+            sys.exit(1)
+        branch_to = children[0]
+
+    gerrit_args = args.gerrit_args
+    if len(gerrit_args) > 0 and gerrit_args[0] == '--':
+        gerrit_args = gerrit_args[1:]
+    # the stub is not in branch_config if some branches were skipped
+    branch_conf = os.path.join(workdir, 'branch.json5')
+    with open(branch_conf, 'w') as f:
+        json.dump({name: branch_config[name] for name in history.branches}, f, indent=4)
+
+    benchmark = Benchmark(stub, workdir, branch_conf, gerrit_args)
+    results = benchmark.run_all(args.scenarios.split(','), history.projects,
+                                branch, branch_to)
+    stub.stop()
+
+    report = {
+        'version': version(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'changes': len(history.changes),
+            'projects': len(history.projects),
+            'branches': len(history.branches),
+            'pick_ratio': args.pick_ratio,
+            'abandon_ratio': args.abandon_ratio,
+            'seed': args.seed,
+            'latency_ms': args.latency,
+            'page_limit': args.page_limit,
+            'branch': branch,
+            'branch_to': branch_to,
+            'gerrit_args': gerrit_args,
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print('| scenario | wall(s) | cpu(s) | requests | bytes | peak rss(KB) | cache rows/s |')
+    print('|----|----|----|----|----|----|----|')
+    for item in results:
+        print('| %s | %.2f | %.2f | %d | %d | %d | %.0f |' %
+              (item['name'], item['wall_time'], item['cpu_time'], item['requests'],
+               item['bytes'], item['peak_rss_kb'], item['cache_rows_per_sec']))
+
+    failed = len([item for item in results if item['returncode'] != 0])
+    if args.baseline:
+        failed += compare(results, args.baseline, args.threshold)
+    if args.workdir is None:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if failed > 0 else 0)
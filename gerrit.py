@@ -1,16 +1,36 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import time
+import calendar
 import datetime
 import json
 import json5
 import sqlite3
+import queue
 import ssl
+import socket
+import zlib
+import codecs
+import csv
 import html
 import http
-import requests
+import http.client
+import http.server
+import io
+import base64
+import hashlib
+import threading
+import asyncio
+import functools
+import itertools
+import bisect
+import contextlib
+import random
+import email.utils
+import concurrent.futures
 from urllib import request
 from urllib import parse
 from typing import List, Dict, Any
@@ -18,33 +38,592 @@ from dateutil import parser as DateParser
 from dateutil import tz
 
 import argparse
+import fnmatch
 import logging
 import logging.config
 
-def timestamp(text: str):
+NS = 1000000000
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+LOCAL_TZ = tz.tzlocal()
+
+def parse_time_ns(text: str, keep_zone: bool = True):
+    # Epoch nanoseconds of `text`. Gerrit's "YYYY-MM-DD HH:MM:SS[.nnnnnnnnn]"
+    # UTC format is parsed by position, other input by dateutil, as UTC
+    # unless it has a zone and `keep_zone` is set.
+    if 19 <= len(text) <= 29 and text[4] == '-' and text[10] == ' ' and \
+        (len(text) == 19 or text[19] == '.'):
+        try:
+            days = datetime.date(int(text[0:4]), int(text[5:7]),
+                                 int(text[8:10])).toordinal() - EPOCH_ORDINAL
+            seconds = days * 86400 + int(text[11:13]) * 3600 + \
+                int(text[14:16]) * 60 + int(text[17:19])
+            return seconds * NS + int(text[20:29].ljust(9, '0'))
+        except ValueError:
+            pass
     tm = DateParser.parse(text)
-    if tm.tzinfo is None:
-        tm.replace(tzinfo=datetime.timezone.utc)
-    return time.mktime(tm.utctimetuple())
+    if tm.tzinfo is None or not keep_zone:
+        tm = tm.replace(tzinfo=datetime.timezone.utc)
+    return calendar.timegm(tm.utctimetuple()) * NS + tm.microsecond * 1000
+
+def gerrit_time(ns: int):
+    return '%s.%09d' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ns // NS)), ns % NS)
+
+def local_time(ns: int):
+    return datetime.datetime.fromtimestamp(ns // NS, LOCAL_TZ).isoformat(
+        sep=' ', timespec='seconds')
+
+def timestamp(text: str):
+    return parse_time_ns(text) / NS
+
+class Change:
+    # The fields of a change used by the reports and the cache, times are
+    # epoch ns. `data` is the json it was decoded from, dropped once the
+    # cache has stored it; rows read from the cache have none.
+    __slots__ = ('number', 'project', 'branch', 'change_id', 'subject',
+                 'status', 'updated', 'submitted', 'revision', 'parents',
+                 'author', 'author_date', 'committer', 'committer_date',
+                 'profile', 'more', 'cached', 'data')
+
+    def __init__(self, number: int, project: str, branch: str, change_id: str,
+                 subject: str, status: str, updated: int, submitted: int = None,
+                 revision: str = None, parents: tuple = (), author: str = None,
+                 author_date: int = None, committer: str = None,
+                 committer_date: int = None, profile: int = 0,
+                 more: bool = False, cached: bool = False, data = None):
+        self.number = number
+        self.project = project
+        self.branch = branch
+        self.change_id = change_id
+        self.subject = subject
+        self.status = status
+        self.updated = updated
+        self.submitted = submitted
+        self.revision = revision
+        self.parents = parents
+        self.author = author
+        self.author_date = author_date
+        self.committer = committer
+        self.committer_date = committer_date
+        self.profile = profile
+        self.more = more
+        self.cached = cached
+        self.data = data
+
+    @classmethod
+    def from_json(cls, change, profile: int = 0):
+        current = change.get('revisions', {}).get(change.get('current_revision'), {})
+        commit = current.get('commit')
+        submitted = change.get('submitted')
+        return cls(change['_number'], change['project'], change['branch'],
+                   change['change_id'], change['subject'], change['status'],
+                   parse_time_ns(change['updated']),
+                   parse_time_ns(submitted) if submitted else None,
+                   change.get('current_revision'),
+                   tuple([p['commit'] for p in commit['parents']]) if commit else (),
+                   commit['author']['name'] if commit else None,
+                   parse_time_ns(commit['author']['date']) if commit else None,
+                   commit['committer']['name'] if commit else None,
+                   parse_time_ns(commit['committer']['date']) if commit else None,
+                   profile, change.get('_more_changes', False), False, change)
+
+    @property
+    def id(self):
+        return '%s~%s~%s' % (parse.quote(self.project, safe=''),
+                             parse.quote(self.branch, safe=''), self.change_id)
+
+    def __repr__(self):
+        return '<Change %d %s %s>' % (self.number, self.branch, self.change_id)
+
+XSSI_PREFIX = b")]}'\n"
+
+def iter_json(read, chunk_size: int = 64 * 1024):
+    # Decode a json array from the byte stream `read` and yield its elements
+    # one at a time, the buffer only ever holds about one element and a chunk.
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = read(chunk_size)
+        eof = len(data) == 0
+        buf = buf[pos:] + utf8.decode(data, final=eof)
+        pos = 0
+
+    def peek():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                return None
+            fill()
+
+    def value():
+        nonlocal pos
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # a number may go on in the next chunk
+                if eof or isinstance(obj, (dict, list, str)) or \
+                    (end < len(buf) and buf[end] not in '0123456789.eE+-'):
+                    pos = end
+                    return obj
+            except ValueError:
+                if eof:
+                    raise
+            fill()
+
+    # the prefix is only skipped at the very beginning of the stream
+    head = b''
+    while len(head) < len(XSSI_PREFIX):
+        data = read(len(XSSI_PREFIX) - len(head))
+        if len(data) == 0:
+            break
+        head += data
+    if head != XSSI_PREFIX:
+        buf = utf8.decode(head)
+
+    if peek() != '[':
+        if peek() is not None:
+            yield value()
+        return
+    pos += 1
+    while True:
+        c = peek()
+        if c == ']':
+            return
+        if c is None:
+            raise ValueError('Unterminated json array')
+        if c == ',':
+            pos += 1
+            continue
+        yield value()
+
+
+HUNK_HEADER = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+FILE_HEADERS = ('diff --git ', '--- ', '+++ ', 'Binary files ')
+
+def patch_id(patch: str):
+    # Fingerprint of a diff in the manner of `git patch-id --stable`: the
+    # file headers and changed lines of each file without whitespace, line
+    # numbers and context, the files summed so their order does not matter.
+    total = 0
+    digest = None
+    old = new = 0
+    for line in patch.splitlines():
+        if old > 0 or new > 0:
+            if line.startswith('-'):
+                old -= 1
+            elif line.startswith('+'):
+                new -= 1
+            elif not line.startswith('\\'):
+                old -= 1
+                new -= 1
+                continue
+            else:
+                continue
+            digest.update(''.join(line.split()).encode('utf-8'))
+            continue
+        if line.startswith('diff --git '):
+            if digest is not None:
+                total += int(digest.hexdigest(), 16)
+            digest = hashlib.sha1()
+        if digest is None:
+            # the commit message of a format-patch
+            continue
+        match = HUNK_HEADER.match(line)
+        if match:
+            old = int(match.group(1) or 1)
+            new = int(match.group(2) or 1)
+        elif line.startswith(FILE_HEADERS):
+            digest.update(''.join(line.split()).encode('utf-8'))
+    if digest is not None:
+        total += int(digest.hexdigest(), 16)
+    return '%040x' % (total % (1 << 160))
+
+
+class Tracer:
+    # spans of http requests, sqlite operations and report phases, written
+    # as a json summary and as a chrome trace(chrome://tracing, perfetto)
+    enabled: bool = None
+    start: int = None
+    events: List[tuple] = None
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.start = time.perf_counter_ns()
+        self.events = []
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def now():
+        return time.perf_counter_ns()
+
+    def record(self, cat: str, name: str, begin: int, end: int = None,
+               args: Dict[str, Any] = None, in_flight: bool = False):
+        if not self.enabled:
+            return
+        if end is None:
+            end = self.now()
+        with self.__lock:
+            self.events.append((cat, name, begin - self.start, end - begin,
+                                threading.get_ident(), args or {}, in_flight))
+
+    @contextlib.contextmanager
+    def span(self, cat: str, name: str, **args):
+        # the yielded dict can be filled with more args inside the span
+        if not self.enabled:
+            yield args
+            return
+        begin = self.now()
+        try:
+            yield args
+        finally:
+            self.record(cat, name, begin, args=args)
+
+    async def trace(self, cat: str, name: str, aw):
+        # a span around an awaitable, it may overlap others on the same thread
+        begin = self.now()
+        try:
+            return await aw
+        finally:
+            self.record(cat, name, begin, in_flight=True)
+
+    def summary(self, counters: Dict[str, Any] = {}):
+        totals = {}
+        requests = []
+        for cat, name, begin, duration, _, args, _ in self.events:
+            item = totals.setdefault(cat, {}).setdefault(
+                name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            item['count'] += 1
+            item['total_ms'] += duration / 1e6
+            item['max_ms'] = max(item['max_ms'], duration / 1e6)
+            if 'bytes' in args:
+                item['bytes'] = item.get('bytes', 0) + args['bytes']
+            if cat == 'http':
+                requests.append(dict(args, endpoint=name,
+                                     start_ms=round(begin / 1e6, 3),
+                                     latency_ms=round(duration / 1e6, 3)))
+        for items in totals.values():
+            for item in items.values():
+                item['total_ms'] = round(item['total_ms'], 3)
+                item['max_ms'] = round(item['max_ms'], 3)
+        return {
+            'wall_ms': round((self.now() - self.start) / 1e6, 3),
+            'counters': counters,
+            'totals': totals,
+            'requests': requests,
+        }
+
+    def write_summary(self, path: str, counters: Dict[str, Any] = {}):
+        with open(path, 'w') as f:
+            json.dump(self.summary(counters), f, indent=4)
+
+    def write_chrome_trace(self, path: str):
+        pid = os.getpid()
+        events = []
+        for index, (cat, name, begin, duration, tid, args, in_flight) in enumerate(self.events):
+            if in_flight:
+                # async events may overlap without nesting
+                events.append({'name': name, 'cat': cat, 'ph': 'b', 'id': index,
+                               'ts': begin / 1e3, 'pid': pid, 'tid': tid, 'args': args})
+                events.append({'name': name, 'cat': cat, 'ph': 'e', 'id': index,
+                               'ts': (begin + duration) / 1e3, 'pid': pid, 'tid': tid})
+            else:
+                events.append({'name': name, 'cat': cat, 'ph': 'X',
+                               'ts': begin / 1e3, 'dur': duration / 1e3,
+                               'pid': pid, 'tid': tid, 'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class ConnectionPool:
+    host: str = None
+    context = None
+    size: int = None
+    verbose: bool = None
+    timeout: float = None
+    connects: int = None
+    reuses: int = None
+    stale: int = None
+
+    def __init__(self, host: str, context, size: int = 4, verbose: bool = False,
+                 timeout: float = None):
+        self.host = host
+        self.context = context
+        self.size = max(1, size)
+        self.verbose = verbose
+        self.timeout = timeout
+        self.connects = 0
+        self.reuses = 0
+        self.stale = 0
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def acquire(self, fresh: bool = False):
+        with self.__lock:
+            if not fresh and len(self.__idle) > 0:
+                self.reuses += 1
+                return self.__idle.pop(), True
+            self.connects += 1
+        conn = http.client.HTTPSConnection(self.host, context=self.context,
+                                           timeout=self.timeout)
+        conn.set_debuglevel(1 if self.verbose else 0)
+        return conn, False
+
+    def release(self, conn, reusable: bool = True):
+        if reusable:
+            with self.__lock:
+                if len(self.__idle) < self.size:
+                    self.__idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn in idle:
+            conn.close()
+
+    @property
+    def handshakes_avoided(self):
+        return self.reuses - self.stale
+
+
+class RateLimiter:
+    rate: float = None
+    burst: int = None
+    waited: float = None
+
+    def __init__(self, rate: float = 0, burst: int = 1):
+        # Token bucket of `rate` requests per second holding up to `burst`
+        # tokens, a rate of 0 only enforces the pauses asked by the server.
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.waited = 0.0
+        self.__tokens = float(self.burst)
+        self.__stamp = time.monotonic()
+        self.__paused = 0.0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        # tokens may go negative, each caller sleeps for its own reservation
+        with self.__lock:
+            now = time.monotonic()
+            wait = max(0.0, self.__paused - now)
+            if self.rate > 0:
+                self.__tokens = min(self.burst,
+                                    self.__tokens + (now - self.__stamp) * self.rate)
+                self.__stamp = now
+                self.__tokens -= 1
+                if self.__tokens < 0:
+                    wait = max(wait, -self.__tokens / self.rate)
+            self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # nothing is sent for `seconds`, e.g. after a Retry-After
+        with self.__lock:
+            self.__paused = max(self.__paused, time.monotonic() + seconds)
+
+
+class PooledResponse:
+    res: http.client.HTTPResponse = None
+    url: str = None
+    size: int = None
+    on_close = None
+
+    def __init__(self, res, conn, pool: ConnectionPool):
+        self.res = res
+        self.size = 0
+        self.__conn = conn
+        self.__pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.res, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, amt: int = None):
+        try:
+            data = self.res.read(amt)
+        except Exception:
+            # not reusable in the middle of a body
+            self.close()
+            raise
+        self.size += len(data)
+        if self.res.isclosed():
+            # http.client ends a partial read of a dropped connection quietly
+            length = self.res.length
+            self.close()
+            if amt and len(data) == 0 and length:
+                raise http.client.IncompleteRead(b'', length)
+        return data
+
+    def close(self):
+        if self.__conn is None:
+            return
+        # the connection can only be reused once the body has been drained
+        reusable = self.res.isclosed() and not self.res.will_close and \
+            not self.res.length
+        self.res.close()
+        self.__pool.release(self.__conn, reusable)
+        self.__conn = None
+        if self.on_close is not None:
+            self.on_close(self.size)
+
+
+class ResponseCache:
+    conn: sqlite3.Connection = None
+    lock: threading.Lock = None
+    max_size: int = None
+    hits: int = None
+    misses: int = None
+    not_modified: int = None
+
+    def __init__(self, db: str, max_size: int = 256 * 1024 * 1024):
+        dir = os.path.dirname(os.path.realpath(__file__))
+        if db is None or db == "":
+            db = os.path.join(dir, '.response.db')
+        self.conn = sqlite3.connect(db, check_same_thread=False,
+                                    timeout=GerritCache.BUSY_TIMEOUT)
+        self.lock = threading.Lock()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        with open(os.path.join(dir, "schema/tbl_responses.sql")) as f:
+            self.conn.executescript(f.read())
+        self.conn.commit()
+
+    @staticmethod
+    def key(identity: str, url: str):
+        return hashlib.sha1(('%s %s' % (identity, url)).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                'SELECT etag, last_modified, body from tbl_responses where key = ?',
+                (key, ))
+            row = cur.fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            cur.execute('UPDATE tbl_responses SET accessed = ? where key = ?',
+                        (time.time_ns(), key))
+            self.conn.commit()
+            return row
+
+    def put(self, key: str, url: str, etag: str, last_modified: str, body: bytes):
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(
+                '''INSERT OR REPLACE INTO tbl_responses
+                    (key, url, etag, last_modified, size, accessed, body)
+                    values (?, ?, ?, ?, ?, ?, ?)''',
+                (key, url, etag, last_modified, len(body), time.time_ns(), body))
+            self.__evict(cur)
+            self.conn.commit()
+
+    def __evict(self, cur):
+        # drop the least recently used responses beyond `max_size`
+        cur.execute('SELECT SUM(size) from tbl_responses')
+        total = cur.fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+        cur.execute('SELECT key, size from tbl_responses ORDER BY accessed')
+        keys = []
+        for key, size in cur.fetchall():
+            if total <= self.max_size:
+                break
+            keys.append((key, ))
+            total -= size
+        cur.executemany('DELETE from tbl_responses where key = ?', keys)
 
-def utc_to_localtime(text: str):
-    dt_utc = DateParser.parse(text)
-    dt_local = dt_utc.replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal())
-    return dt_local.isoformat(sep=' ', timespec='seconds')
 
 class Gerrit:
+    # bits of ListChangesOption for the O= parameter of change queries
+    CHANGE_OPTIONS = {
+        'LABELS': 0,
+        'CURRENT_REVISION': 1,
+        'ALL_REVISIONS': 2,
+        'CURRENT_COMMIT': 3,
+        'ALL_COMMITS': 4,
+        'CURRENT_FILES': 5,
+        'ALL_FILES': 6,
+        'DETAILED_ACCOUNTS': 7,
+        'DETAILED_LABELS': 8,
+        'MESSAGES': 9,
+        'SKIP_MERGEABLE': 22,
+        'SKIP_DIFFSTAT': 23,
+    }
+    SKIP_OPTIONS = ['SKIP_MERGEABLE', 'SKIP_DIFFSTAT']
+    # named sets of options, chosen per call site
+    PROFILES = {
+        'report': ['CURRENT_REVISION', 'CURRENT_COMMIT', 'SKIP_MERGEABLE',
+                   'SKIP_DIFFSTAT'],
+        'full': ['CURRENT_REVISION', 'CURRENT_COMMIT'],
+        'cache': ['CURRENT_REVISION', 'CURRENT_COMMIT', 'CURRENT_FILES',
+                  'DETAILED_ACCOUNTS'],
+    }
+
     context = None
     host: str = None
     auth: None
     auth_basic: None
     auth_digest: None
+    pool: ConnectionPool = None
+    batch_size: int = None
+    # whether walk_history can answer the history of ancestor branches
+    commit_index: bool = False
+    page_size: int = None
+    # the page size in use, shrunk while the server is slow
+    page_limit: int = None
+    limiter: RateLimiter = None
+    retries: int = None
+    retried: int = None
+    recovered: int = None
+    page_shrinks: int = None
+    transfer: Dict[str, List[int]] = None
+    responses: ResponseCache = None
+    tracer: Tracer = None
+    # options of change queries that do not name any
+    default_profile: str = None
+
+    # responses worth another try, after Retry-After or a backoff
+    RETRY_STATUS = (429, 502, 503, 504)
+    BACKOFF = 1.0
+    BACKOFF_MAX = 60.0
+    PAGE_MIN = 10
 
     def __init__(self,
                  host,
                  user,
                  password,
                  insecure: bool = True,
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 pool_size: int = 4,
+                 pool: ConnectionPool = None,
+                 batch_size: int = 50,
+                 page_size: int = 500,
+                 responses: ResponseCache = None,
+                 tracer: Tracer = None,
+                 limiter: RateLimiter = None,
+                 retries: int = 3,
+                 timeout: float = 60):
         if not insecure:
             self.context = ssl._create_default_https_context()
         else:
@@ -55,12 +634,49 @@ class Gerrit:
 
         self.auth_basic = request.HTTPBasicAuthHandler(self.auth)
         self.auth_digest = request.HTTPDigestAuthHandler(self.auth)
-
-        request.install_opener(
-            request.build_opener(
-                self.auth_basic, self.auth_digest,
-                request.HTTPSHandler(debuglevel=verbose,
-                                     context=self.context)))
+        self.__authorization = None
+        self.__challenge = None
+
+        if pool is None:
+            pool = ConnectionPool(host, self.context, pool_size, verbose, timeout)
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.page_size = max(1, page_size)
+        self.page_limit = self.page_size
+        self.limiter = limiter or RateLimiter()
+        self.retries = max(0, retries)
+        self.retried = 0
+        self.recovered = 0
+        self.page_shrinks = 0
+        self.transfer = {}
+        self.__transfer_lock = threading.Lock()
+        self.responses = responses
+        self.tracer = tracer or Tracer()
+
+    @classmethod
+    def profile_mask(cls, profile: str):
+        mask = 0
+        for option in cls.PROFILES[profile]:
+            mask |= 1 << cls.CHANGE_OPTIONS[option]
+        return mask
+
+    @classmethod
+    def data_mask(cls, mask: int):
+        # the bits of `mask` that change the data returned
+        for option in cls.SKIP_OPTIONS:
+            mask &= ~(1 << cls.CHANGE_OPTIONS[option])
+        return mask
+
+    @classmethod
+    def options(cls, profile: str = 'full'):
+        return 'O=%x' % (cls.profile_mask(profile))
+
+    @classmethod
+    def profile_name(cls, mask: int):
+        for profile in cls.PROFILES:
+            if cls.profile_mask(profile) == mask:
+                return profile
+        return 'O=%x' % (mask)
 
     def url_for_change(self, number: str):
         return 'https://%s/#/c/%s/' % (self.host, number)
@@ -73,63 +689,343 @@ class Gerrit:
             url = 'https://%s/a/%s' % (self.host, path)
         return url
 
-    def __get_content(self, res):
-        if res.getcode() == requests.codes.ok:
-            return res.read().decode('utf-8').replace(")]}'\n", "")
-        else:
-            res.raise_for_status()
-
-    def __get_json(self, res):
-        content = self.__get_content(res)
+    def __get_content(self, res, label: str):
+        if res.status == http.HTTPStatus.OK:
+            content = res.read()
+            self.__record_transfer(label, len(content))
+            if content.startswith(XSSI_PREFIX):
+                content = content[len(XSSI_PREFIX):]
+            return content
+        res.read()
+        res.close()
+        raise request.HTTPError(res.url, res.status, res.reason, res.headers, None)
+
+    def __iter_json(self, res, label: str):
+        size = 0
+
+        def read(amt: int):
+            nonlocal size
+            try:
+                data = res.read(amt)
+            except http.client.IncompleteRead:
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                # the request went through get(), only its body broke off
+                raise http.client.IncompleteRead(b'', None) from e
+            size += len(data)
+            return data
+
+        try:
+            yield from iter_json(read)
+        finally:
+            res.close()
+            self.__record_transfer(label, size)
+
+    def __get_json(self, res, label: str = ''):
+        content = self.__get_content(res, label)
         return json.loads(content)
 
-    def get(self, url):
+    def __record_transfer(self, label: str, size: int):
+        with self.__transfer_lock:
+            item = self.transfer.setdefault(label, [0, 0])
+            item[0] += 1
+            item[1] += size
+
+    def __auth_header(self, url: str):
+        if self.__challenge is not None:
+            req = request.Request(url, method="GET")
+            auth = self.auth_digest.get_authorization(req, self.__challenge)
+            if auth:
+                return 'Digest %s' % (auth)
+        return self.__authorization
+
+    def __update_auth(self, url: str, challenge: str):
+        if challenge is None:
+            return False
+        scheme, _, rest = challenge.partition(' ')
+        if scheme.lower() == 'digest':
+            self.__challenge = request.parse_keqv_list(
+                filter(None, request.parse_http_list(rest)))
+            return True
+        if scheme.lower() == 'basic':
+            user, password = self.auth.find_user_password(None, url)
+            if user is None:
+                return False
+            raw = ('%s:%s' % (user, password)).encode('utf-8')
+            self.__authorization = 'Basic %s' % (
+                base64.b64encode(raw).decode('ascii'))
+            self.__challenge = None
+            return True
+        return False
+
+    def __send(self, url: str, headers: Dict[str, str]):
+        parts = parse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        auth = self.__auth_header(url)
+        if auth is not None:
+            headers = dict(headers, Authorization=auth)
+
+        conn, reused = self.pool.acquire()
+        try:
+            conn.request('GET', path, headers=headers)
+            res = conn.getresponse()
+        except Exception as e:
+            # e.g. after a timeout or a TLS error the connection is never
+            # put back in the pool
+            conn.close()
+            if not reused or \
+                not isinstance(e, (http.client.HTTPException, ConnectionError)):
+                raise
+            # idle keep-alive connection was dropped by the server
+            self.pool.stale += 1
+            conn, reused = self.pool.acquire(fresh=True)
+            try:
+                conn.request('GET', path, headers=headers)
+                res = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        return PooledResponse(res, conn, self.pool)
+
+    def __backoff(self, attempt: int):
+        # exponential with jitter, so that retrying clients do not sync up
+        delay = min(self.BACKOFF_MAX, self.BACKOFF * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def retry_after(value: str):
+        # seconds of a Retry-After header, given as seconds or as a date
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() -
+                       time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def __shrink_page(self):
+        with self.__transfer_lock:
+            if self.page_limit > self.PAGE_MIN:
+                self.page_limit = max(self.PAGE_MIN, self.page_limit // 2)
+                self.page_shrinks += 1
+                logging.debug('Page size: %d' % (self.page_limit))
+
+    def __attempt(self, url: str, headers: Dict[str, str]):
+        self.limiter.acquire()
+        res = self.__send(url, headers)
+        if res.status == 401:
+            challenge = res.getheader('WWW-Authenticate')
+            res.read()
+            res.close()
+            if self.__update_auth(url, challenge):
+                self.limiter.acquire()
+                res = self.__send(url, headers)
+        return res
+
+    def get(self, url, headers: Dict[str, str] = {}):
+        # Throttled by `limiter`, retried `retries` times on connection
+        # errors, timeouts and RETRY_STATUS. A timeout also shrinks the page
+        # size of the following queries.
         url = self.__get_url(url)
         logging.debug('GET %s' % (url))
-        req = request.Request(url, method="GET")
-        return request.urlopen(req)
-
-    def get_json(self, url):
+        attempt = 0
+        while True:
+            start = self.tracer.now()
+            try:
+                res = self.__attempt(url, headers)
+            except (OSError, http.client.HTTPException) as e:
+                if isinstance(e, socket.timeout):
+                    self.__shrink_page()
+                if attempt >= self.retries:
+                    raise
+                delay = self.__backoff(attempt)
+                logging.warning('GET %s: %s, retry in %.1fs' % (url, e, delay))
+            else:
+                if res.status not in self.RETRY_STATUS or attempt >= self.retries:
+                    break
+                delay = self.retry_after(res.getheader('Retry-After'))
+                res.read()
+                res.close()
+                if delay is not None:
+                    # asked by the server, every request waits
+                    self.limiter.pause(delay)
+                    delay = 0
+                else:
+                    delay = self.__backoff(attempt)
+                logging.warning('GET %s: %d, retry in %.1fs' % (url, res.status, delay))
+            with self.__transfer_lock:
+                self.retried += 1
+            attempt += 1
+            time.sleep(delay)
+        if attempt > 0:
+            with self.__transfer_lock:
+                self.recovered += 1
+        res.url = url
+        if self.tracer.enabled:
+            # recorded once the body has been read
+            res.on_close = functools.partial(self.__trace_request, url,
+                                             res.status, start, self.tracer.now())
+        if res.status == 304 and ('If-None-Match' in headers or
+                                  'If-Modified-Since' in headers):
+            return res
+        if res.status < 200 or res.status >= 300:
+            if res.on_close is not None:
+                res.on_close, on_close = None, res.on_close
+                on_close(0)
+            raise request.HTTPError(url, res.status, res.reason, res.headers,
+                                    res)
+        return res
+
+    def __trace_request(self, url: str, status: int, start: int, headers: int,
+                        size: int):
+        parts = parse.urlsplit(url)
+        endpoint = re.sub(r'^(/a)?/changes/[^/]+', r'\1/changes/{id}', parts.path)
+        qs = parse.parse_qs(parts.query)
+        args = {'status': status, 'bytes': size,
+                'headers_ms': round((headers - start) / 1e6, 3)}
+        if 'q' in qs:
+            args['query'] = qs['q'][0]
+        if 'S' in qs and 'n' in qs:
+            args['page'] = int(qs['S'][0]) // max(1, int(qs['n'][0]))
+        self.tracer.record('http', endpoint, start, args=args)
+
+    def get_conditional(self, url, label: str = ''):
+        # Body of `url`, revalidated with the ETag/Last-Modified of the copy
+        # in the response cache and served from there on 304.
+        if self.responses is None:
+            return self.__get_content(self.get(url), label)
+
+        identity, _ = self.auth.find_user_password(None, self.__get_url(url))
+        key = self.responses.key(identity, self.__get_url(url))
+        cached = self.responses.get(key)
+        headers = {}
+        if cached is not None:
+            if cached[0]:
+                headers['If-None-Match'] = cached[0]
+            if cached[1]:
+                headers['If-Modified-Since'] = cached[1]
+
+        res = self.get(url, headers)
+        if res.status == 304:
+            res.read()
+            res.close()
+            self.responses.not_modified += 1
+            return cached[2]
+
+        content = self.__get_content(res, label)
+        etag = res.getheader('ETag')
+        last_modified = res.getheader('Last-Modified')
+        if etag or last_modified:
+            self.responses.put(key, self.__get_url(url), etag, last_modified,
+                               content)
+        return content
+
+    def get_json(self, url, label: str = ''):
         res = self.get(url)
-        return self.__get_json(res)
+        return self.__get_json(res, label)
 
     def search(self, path, search: List[str], queries: List[str] = []):
+        return list(self.iter_search(path, search, queries))
+
+    def iter_search(self, path, search: List[str], queries: List[str] = []):
         q = ['q=%s' % ('+'.join(search))] + queries
         url = '%s?%s' % (path, '&'.join(q))
-        return self.get_json(url)
+        options = [q for q in queries if q.startswith('O=')]
+        label = self.profile_name(int(options[0][2:], 16)) if options else 'O=0'
+        return self.__iter_json(self.get(url), label)
+
+    def __iter_changes(self, search: List[str], queries: List[str] = []):
+        options = [q for q in queries if q.startswith('O=')]
+        if len(options) == 0 and self.default_profile is not None:
+            options = [self.options(self.default_profile)]
+            queries = queries + options
+        profile = int(options[0][2:], 16) if options else 0
+        for chg in self.iter_search('/changes/', search, queries):
+            yield Change.from_json(chg, profile)
 
     def query_changes(self, search: List[str], queries: List[str] = []):
-        return self.search('/changes/', search, queries)
+        return list(self.__iter_changes(search, queries))
+
+    def iter_query_changes(self, search: List[str], queries: List[str] = []):
+        return self.__iter_changes(search, queries)
 
     def query_changes_between(self,
                               search: List[str],
                               queries: List[str],
                               since: str = None,
                               until: str = None):
-        changes = []
+        return list(self.iter_changes_between(search, queries, since, until))
+
+    def iter_changes_between(self,
+                             search: List[str],
+                             queries: List[str],
+                             since: str = None,
+                             until: str = None):
+        range = []
+        if since is not None and since != '':
+            range.append('since:"%s"' % self.__time_format(since))
+        if until is not None and until != '':
+            range.append('until:"%s"' % self.__time_format(until))
+        return self.__paginate(self.iter_query_changes, search + range, queries)
+
+    def __paginate(self, fetch, search: List[str], queries: List[str] = []):
+        # Page through the results with n=/S= and yield every change once,
+        # `seen` guards against changes shifting between pages. The page
+        # size shrinks while the first change of a page takes more than a
+        # quarter of the timeout and grows back below a sixteenth. A page
+        # whose body broke off is fetched again from where it stopped,
+        # smaller; a request that failed was already retried by get().
+        # Returns False once a page was resumed, changes that shifted while
+        # the page was retried may be missing.
+        seen = set()
+        start = 0
+        failures = 0
+        intact = True
         while True:
-            range = []
-            if since is not None and since != '':
-                range.append('since:"%s"' % self.__time_format(since))
-            if until is not None and until != '':
-                range.append('until:"%s"' % self.__time_format(until))
-            res = self.query_changes(search + range, queries)
-
-            def change_exist(id):
-                for ch in changes:
-                    if ch['id'] == id:
-                        return True
-                return False
-
-            for chg in res:
-                if change_exist(chg['id']):
-                    continue
-                changes.append(chg)
-
-            if len(res) < 500:
-                break
-            until = res[500 - 1]['submitted']
-        return changes
+            count = 0
+            more = False
+            size = self.page_limit
+            begin = time.monotonic()
+            latency = None
+            try:
+                for chg in fetch(search, queries + ['n=%d' % (size),
+                                                    'S=%d' % (start)]):
+                    if latency is None:
+                        latency = time.monotonic() - begin
+                    count += 1
+                    more = chg.more
+                    if chg.number in seen:
+                        continue
+                    seen.add(chg.number)
+                    yield chg
+            except http.client.IncompleteRead as e:
+                if failures >= self.retries:
+                    raise
+                failures += 1
+                intact = False
+                self.__shrink_page()
+                logging.warning('Page at %d: %s, fetched again' % (start + count, e))
+                start += count
+                continue
+
+            if failures > 0:
+                with self.__transfer_lock:
+                    self.recovered += 1
+                failures = 0
+            timeout = self.pool.timeout
+            if latency is not None and timeout is not None:
+                if latency > timeout / 4:
+                    self.__shrink_page()
+                elif latency < timeout / 16 and count == size and \
+                    size < self.page_size:
+                    self.page_limit = min(self.page_size, size * 2)
+            start += count
+            if count == 0 or not more:
+                return intact
 
     def query_changes_between_branches(self,
                                     search: List[str],
@@ -145,186 +1041,809 @@ class Gerrit:
 
             res = self.query_changes_between(new_search, queries, since, until)
 
-            def change_exist(id):
-                for ch in changes:
-                    if ch['id'] == id:
-                        return True
-                return False
-
-            last_chg = None
-            for chg in res:
-                if change_exist(chg['id']) or \
-                    (parent_id is not None and chg['current_revision'] != parent_id):
-                    continue
-                if parent_id is not None:
-                    parent_id = None
-                changes.append(chg)
-                last_chg = chg
-
+            last_chg, parent_id = self.splice_branch(changes, res, parent_id)
             if last_chg is not None:
-                until = last_chg['submitted']
-                parent_id = last_chg["revisions"][last_chg["current_revision"]]["commit"]["parents"][0]["commit"]
+                until = gerrit_time(last_chg.submitted or last_chg.updated)
         return changes
 
+    def walk_history(self,
+                     search: List[str],
+                     queries: List[str],
+                     commit_id: str,
+                     since: str = None,
+                     until: str = None):
+        # merged changes reachable from `commit_id`, None if unknown
+        return None
+
+    @staticmethod
+    def splice_branch(changes: List, res: List, parent_id: str = None):
+        # Append the history of an ancestor branch, starting at the fork point
+        # `parent_id` of its child. Returns the oldest change appended and the
+        # fork point to look for in the next ancestor.
+        seen = set([ch.number for ch in changes])
+
+        last_chg = None
+        for chg in res:
+            if chg.number in seen or \
+                (parent_id is not None and chg.revision != parent_id):
+                continue
+            if parent_id is not None:
+                parent_id = None
+            changes.append(chg)
+            seen.add(chg.number)
+            last_chg = chg
+
+        if last_chg is not None:
+            parent_id = last_chg.parents[0]
+        return last_chg, parent_id
+
     def get_change(self, id: str):
         url = '/changes/%s' % (id)
-        res = self.get(url)
-        return self.__get_json(res)
+        return Change.from_json(json.loads(self.get_conditional(url, 'change')))
 
     def get_change_detail(self, id: str):
         url = '/changes/%s/detail' % (id)
-        res = self.get(url)
-        return self.__get_json(res)
+        return json.loads(self.get_conditional(url, 'detail'))
 
     def get_change_cherry_pick(self, change, branch_to: str = None):
         searches = [
-            'project:%s' % (change['project']),
-            'change:%s' % (change['change_id']),
-            '-change:%d' % (change['_number']), '-is:abandoned'
+            'project:%s' % (change.project),
+            'change:%s' % (change.change_id),
+            '-change:%d' % (change.number), '-is:abandoned'
         ]
         if branch_to is not None and branch_to != '':
             searches.append('branch:%s' % (branch_to))
-        return self.query_changes(searches, ['O=a'])
+        return self.query_changes(searches, [self.options('report')])
+
+    def get_changes_cherry_pick(self, changes: List, branch_to: str = None):
+        results = []
+        for index in range(0, len(changes), self.batch_size):
+            results += self.__get_changes_cherry_pick(
+                changes[index:index + self.batch_size], branch_to)
+        return results
+
+    def __get_changes_cherry_pick(self, changes: List, branch_to: str = None):
+        change_ids = {}
+        for change in changes:
+            change_ids.setdefault(change.project, set()).add(change.change_id)
+
+        found = {}
+        for project, ids in change_ids.items():
+            searches = [
+                'project:%s' % (project),
+                '(%s)' % (' OR '.join(['change:%s' % (id) for id in sorted(ids)])),
+                '-is:abandoned'
+            ]
+            if branch_to is not None and branch_to != '':
+                searches.append('branch:%s' % (branch_to))
+            for chg in self.__paginate(self.__iter_changes, searches, [self.options('report')]):
+                found.setdefault((project, chg.change_id), []).append(chg)
+
+        # split back per source change, dropping the source change itself
+        results = []
+        for change in changes:
+            cherries = found.get((change.project, change.change_id), [])
+            results.append([
+                chg for chg in cherries if chg.number != change.number
+            ])
+        return results
+
+    def get_patch_id(self, change):
+        # fingerprint of the current revision of `change`
+        url = '/changes/%d/revisions/%s/patch' % (change.number, change.revision)
+        content = self.__get_content(self.get(url), 'patch')
+        return patch_id(base64.b64decode(content).decode('utf-8', 'replace'))
+
+    def get_patch_ids(self, changes: List):
+        return [self.get_patch_id(change) for change in changes]
+
+    def list_projects(self, pattern: str = '*'):
+        # names of the visible projects matching the glob `pattern`
+        prefix = re.split(r'[*?\[]', pattern)[0]
+        projects = self.get_json('/projects/?p=%s' % (parse.quote(prefix, safe='')),
+                                 'projects')
+        return sorted([name for name in projects
+                       if fnmatch.fnmatchcase(name, pattern)])
 
     def get_change_cherry_pick_by_id(self, id: str, branch_to: str = None):
         change = self.get_change(id)
         return self.get_change_cherry_pick(change, branch_to)
 
     def __time_format(self, text: str):
+        # the zone of the input is dropped, the time is sent as UTC
         if text is not None and text != '':
-            return DateParser.parse(text).replace(tzinfo=datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            return time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.gmtime(parse_time_ns(text, False) // NS))
         return text
 
-class GerritCache:
-    conn: sqlite3.Connection = None
+    def time_epoch(self, text: str):
+        # epoch seconds of the time sent to gerrit for `text`
+        return parse_time_ns(text, False) // NS
 
-    def __init__(self, db: str):
+class GerritCache:
+    db: str = None
+    readers: int = None
+    compress: bool = None
+    ingest_rows: int = None
+    ingest_time: float = None
+    # called on the writer thread with the (number, project, branch) of the
+    # rows of each committed ingest
+    listeners: List = None
+
+    # every change of the schema files bumps the version, they are only run
+    # against databases of an older version
+    SCHEMA_VERSION = 5
+    # seconds to wait for the lock of another process
+    BUSY_TIMEOUT = 60
+    # search terms whose results can be answered from tbl_changes
+    QUERIES = {
+        '': '',
+        'is:merged': "and status = 'MERGED'",
+        'status:merged': "and status = 'MERGED'",
+        '-is:abandoned': "and status != 'ABANDONED'",
+    }
+    # columns a report needs, selected instead of decoding `data`
+    COLUMNS = '''number, project, branch, change_id, status, update_time,
+                 commit_id, parent, parent2, author, author_date, committer,
+                 committer_date, subject'''
+
+    def __init__(self, db: str, compress: bool = False, tracer: Tracer = None,
+                 readers: int = 4):
+        # Shared by processes through WAL. Writes of all threads go through a
+        # queue to the one connection of the writer thread, reads use a pool
+        # of `readers` read-only connections and never wait for a write.
         dir = os.path.dirname(os.path.realpath(__file__))
+        self.tracer = tracer or Tracer()
         if db is None or db == "":
             db = os.path.join(dir, '.cache.db')
-        self.conn = sqlite3.connect(db)
-        with open(os.path.join(dir, "schema/tbl_changes.sql")) as f:
-            self.conn.executescript(f.read())
-        self.conn.commit()
+        self.db = os.path.abspath(db)
+        self.readers = max(1, readers)
+        self.compress = compress
+        self.ingest_rows = 0
+        self.ingest_time = 0.0
+        self.listeners = []
+        self.__local = threading.local()
+        self.__pool = queue.LifoQueue()
+        self.__pool_lock = threading.Lock()
+        self.__opened = 0
+        self.__writes = queue.Queue()
+        self.__writer = None
+        self.__conn = self.__connect(False)
+
+        cur = self.__conn.cursor()
+        cur.execute('PRAGMA user_version')
+        version = cur.fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            self.__conn.execute('PRAGMA journal_mode = WAL')
+            for schema in ["schema/tbl_changes.sql", "schema/tbl_sync.sql",
+                           "schema/tbl_coverage.sql", "schema/tbl_commits.sql",
+                           "schema/tbl_patches.sql"]:
+                with open(os.path.join(dir, schema)) as f:
+                    self.__conn.executescript(f.read())
+            self.__migrate(version)
+            self.__conn.commit()
+
+        self.__writer = threading.Thread(target=self.__write_loop,
+                                         name='cache-writer', daemon=True)
+        self.__writer.start()
+
+    def __connect(self, read_only: bool):
+        if read_only:
+            conn = sqlite3.connect('file:%s?mode=ro' % (request.pathname2url(self.db)),
+                                   uri=True, check_same_thread=False,
+                                   timeout=self.BUSY_TIMEOUT)
+        else:
+            # the write lock is taken at BEGIN, a read lock is never upgraded
+            conn = sqlite3.connect(self.db, check_same_thread=False,
+                                   timeout=self.BUSY_TIMEOUT,
+                                   isolation_level='IMMEDIATE')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -65536')
+        return conn
+
+    @property
+    def conn(self):
+        # the connection of the current read, or the one of the writer
+        conn = getattr(self.__local, 'conn', None)
+        return conn if conn is not None else self.__conn
+
+    def close(self):
+        if self.__writer is not None:
+            self.__writes.put(None)
+            self.__writer.join()
+            self.__writer = None
+        while True:
+            try:
+                self.__pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self.__conn.close()
+
+    def __write_loop(self):
+        while True:
+            item = self.__writes.get()
+            if item is None:
+                return
+            func, args, kwargs, future = item
+            try:
+                with self.tracer.span('sqlite', func.__name__):
+                    future.set_result(func(self, *args, **kwargs))
+            except BaseException as e:
+                self.__conn.rollback()
+                future.set_exception(e)
+
+    def __acquire(self):
+        try:
+            return self.__pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self.__pool_lock:
+            create = self.__opened < self.readers
+            if create:
+                self.__opened += 1
+        if create:
+            return self.__connect(True)
+        return self.__pool.get()
+
+    def __migrate(self, version: int):
+        cur = self.conn.cursor()
+        if version < 2:
+            self.__migrate_columns(cur)
+        if version < 3:
+            # index the commits of the merged changes cached so far
+            cur.execute(
+                '''INSERT OR IGNORE INTO tbl_commits
+                    (commit_id, project, number, parent, parent2)
+                    SELECT commit_id, project, number, parent, parent2
+                    from tbl_changes where status = 'MERGED'
+                    and commit_id IS NOT NULL''')
+            if cur.rowcount > 0:
+                logging.info('Cache: indexed %d commits' % (cur.rowcount))
+
+        cur.execute('PRAGMA user_version = %d' % (self.SCHEMA_VERSION))
+
+    def __migrate_columns(self, cur):
+        cur.execute('PRAGMA table_info(tbl_changes)')
+        columns = [row[1] for row in cur.fetchall()]
+        if 'subject' not in columns:
+            cur.execute('ALTER TABLE tbl_changes ADD COLUMN subject TEXT DEFAULT NULL')
+        if 'profile' not in columns:
+            cur.execute('ALTER TABLE tbl_changes ADD COLUMN profile INTEGER DEFAULT NULL')
+
+        # older versions always fetched with the 'full' options
+        cur.execute('UPDATE tbl_changes SET profile = ? WHERE profile IS NULL',
+                    (Gerrit.profile_mask('full'), ))
+
+        # backfill the columns of rows written by older versions from `data`
+        count = 0
+        while True:
+            cur.execute(
+                'SELECT data from tbl_changes where subject IS NULL LIMIT 1000')
+            rows = cur.fetchall()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                self.insert(Change.from_json(self.__load(row[0]),
+                                             Gerrit.profile_mask('full')))
+            count += len(rows)
+        if count > 0:
+            logging.info('Cache: migrated %d changes' % (count))
+
+    def __dump(self, change):
+        data = json.dumps(change)
+        if self.compress:
+            return zlib.compress(data.encode('utf-8'))
+        return data
 
     @staticmethod
-    def __timestamp(value: str):
-        if value is not None:
-            return timestamp(value)
-        return None
+    def __load(data):
+        if isinstance(data, bytes):
+            data = zlib.decompress(data).decode('utf-8')
+        return json.loads(data)
 
+    @staticmethod
+    def __to_change(row):
+        # only the cached columns, `cached` keeps it from being written back
+        # over the full data; commit dates have a precision of seconds
+        (number, project, branch, change_id, status, update_time, commit_id,
+         parent, parent2, author, author_date, committer, committer_date,
+         subject) = row
+        return Change(number, project, branch, change_id, subject, status,
+                      update_time * NS, None, commit_id,
+                      tuple([p for p in (parent, parent2) if p is not None]),
+                      author,
+                      author_date * NS if author_date is not None else None,
+                      committer,
+                      committer_date * NS if committer_date is not None else None,
+                      cached=True)
+
+    def __writer__(func):
+        # run on the writer thread, the caller waits for the result
+        @functools.wraps(func)
+        def __decorated_writer(self, *args, **kwargs):
+            if self.__writer is None or threading.current_thread() is self.__writer:
+                return func(self, *args, **kwargs)
+            future = concurrent.futures.Future()
+            self.__writes.put((func, args, kwargs, future))
+            return future.result()
+
+        return __decorated_writer
+
+    def __reader__(func):
+        # run with a pooled read-only connection, or with the connection of
+        # the writer inside a write
+        @functools.wraps(func)
+        def __decorated_reader(self, *args, **kwargs):
+            if getattr(self.__local, 'conn', None) is not None or \
+                self.__writer is None or threading.current_thread() is self.__writer:
+                return func(self, *args, **kwargs)
+            conn = self.__acquire()
+            self.__local.conn = conn
+            try:
+                with self.tracer.span('sqlite', func.__name__):
+                    return func(self, *args, **kwargs)
+            finally:
+                self.__local.conn = None
+                self.__pool.put(conn)
+
+        return __decorated_reader
+
+    def __to_row(self, change: Change):
+        parents = change.parents + (None, None)
+        return (change.number, change.project, change.branch,
+                change.change_id, change.status,
+                change.updated // NS, change.revision,
+                parents[0], parents[1],
+                change.author,
+                change.author_date // NS if change.author_date is not None else None,
+                change.committer,
+                change.committer_date // NS if change.committer_date is not None else None,
+                change.subject,
+                change.profile,
+                self.__dump(change.data))
+
+    @__writer__
     def insert(self, change):
         cur = self.conn.cursor()
-
-        current_revision = change['revisions'][change['current_revision']]
-        parent = None
-        parent2 = None
-        if len(current_revision['commit']['parents']) > 0:
-            parent = current_revision['commit']['parents'][0]['commit']
-        if len(current_revision['commit']['parents']) > 1:
-            parent2 = current_revision['commit']['parents'][1]['commit']
-
         cur.execute(
             '''INSERT OR REPLACE INTO tbl_changes
                 (number, project, branch, change_id, status, update_time,
-                 parent, parent2, author, author_date, committer, committer_date,
-                 data)
+                 commit_id, parent, parent2, author, author_date, committer,
+                 committer_date, subject, profile, data)
                 values (?, ?, ?, ?, ?, ?,
                         ?, ?, ?, ?, ?, ?,
-                        ?)''',
-            (int(change['_number']), change['project'], change['branch'],
-             change['change_id'], change['status'],
-             self.__timestamp(change['updated']), parent, parent2,
-             current_revision['commit']['author']['name'],
-             self.__timestamp(current_revision['commit']['author']['date']),
-             current_revision['commit']['committer']['name'],
-             self.__timestamp(current_revision['commit']['committer']['date']),
-             json.dumps(change)))
+                        ?, ?, ?, ?)''', self.__to_row(change))
 
+    @__writer__
     def update(self, change, commit: bool = True):
-        cur = self.conn.cursor()
-        cur.execute('''SELECT status from tbl_changes where number = ?''',
-                    (int(change['_number']), ))
-        row = cur.fetchone()
-        if row is None or row[0] != 'MERGED':
-            self.insert(change)
-            if commit:
-                self.conn.commit()
+        self.ingest([change], commit=commit)
 
+    @__writer__
     def update_list(self, changes):
-        for chg in changes:
-            self.update(chg, False)
-        self.conn.commit()
-
+        self.ingest(changes)
+
+    @__writer__
+    def ingest(self, changes, batch_size: int = 1000, commit: bool = True):
+        # Upsert a list or stream of changes with one statement per batch,
+        # a MERGED row is final and only overwritten to add data fetched
+        # with more options.
+        data = Gerrit.data_mask(-1)
+        start = time.time()
+        cur = self.conn.cursor()
+        count = 0
+        rows = []
+        written = []
+        for chg in itertools.chain(changes, [None]):
+            if chg is not None and not chg.cached and chg.data is not None:
+                rows.append(self.__to_row(chg))
+            if len(rows) == 0 or (chg is not None and len(rows) < batch_size):
+                continue
+            # the parents of a merged commit never change
+            cur.executemany(
+                '''INSERT OR IGNORE INTO tbl_commits
+                    (commit_id, project, number, parent, parent2)
+                    values (?, ?, ?, ?, ?)''',
+                [(row[6], row[1], row[0], row[7], row[8]) for row in rows
+                 if row[4] == 'MERGED' and row[6] is not None])
+            cur.executemany(
+                '''INSERT INTO tbl_changes
+                    (number, project, branch, change_id, status, update_time,
+                     commit_id, parent, parent2, author, author_date, committer,
+                     committer_date, subject, profile, data)
+                    values (?, ?, ?, ?, ?, ?,
+                            ?, ?, ?, ?, ?, ?,
+                            ?, ?, ?, ?)
+                    ON CONFLICT(number) DO UPDATE SET
+                     project = excluded.project, branch = excluded.branch,
+                     change_id = excluded.change_id, status = excluded.status,
+                     update_time = excluded.update_time,
+                     commit_id = excluded.commit_id, parent = excluded.parent,
+                     parent2 = excluded.parent2, author = excluded.author,
+                     author_date = excluded.author_date,
+                     committer = excluded.committer,
+                     committer_date = excluded.committer_date,
+                     subject = excluded.subject, profile = excluded.profile,
+                     data = excluded.data
+                    WHERE tbl_changes.status != 'MERGED'
+                     or (excluded.profile & %d) & ~tbl_changes.profile != 0''' %
+                (data), rows)
+            count += len(rows)
+            written.extend([row[:3] for row in rows])
+            rows = []
+        if commit:
+            self.conn.commit()
+            if len(written) > 0:
+                for listener in self.listeners:
+                    listener(written)
+
+        elapsed = time.time() - start
+        self.ingest_rows += count
+        self.ingest_time += elapsed
+        if count > 0:
+            logging.debug('Cache: wrote %d changes in %.3fs (%d rows/s)' %
+                          (count, elapsed, count / max(elapsed, 1e-6)))
+        return count
+
+    @__reader__
     def get(self, project: str, branch: str, change_id: str):
         cur = self.conn.cursor()
         cur.execute(
-            '''SELECT data from tbl_changes where
-                       project = ? and branch = ? and change_id = ?''', (
+            '''SELECT %s from tbl_changes where
+                       project = ? and branch = ? and change_id = ?''' % (self.COLUMNS), (
                 project,
                 branch,
                 change_id,
             ))
         row = cur.fetchone()
-        return json.loads(row[0]) if row else None
+        return self.__to_change(row) if row else None
 
+    @__reader__
     def get_by_number(self, number: str):
         cur = self.conn.cursor()
         cur.execute(
-            'SELECT data from tbl_changes where number = ?',
-            (int(number)),
+            'SELECT %s from tbl_changes where number = ?' % (self.COLUMNS),
+            (int(number), ),
         )
         row = cur.fetchone()
-        return json.loads(row[0]) if row else None
+        return self.__to_change(row) if row else None
 
+    @__reader__
+    def get_by_numbers(self, numbers: List[int]):
+        cur = self.conn.cursor()
+        changes = []
+        for index in range(0, len(numbers), 500):
+            chunk = numbers[index:index + 500]
+            cur.execute(
+                'SELECT %s from tbl_changes where number in (%s)' %
+                (self.COLUMNS, ','.join(['?'] * len(chunk))), chunk)
+            changes.extend([self.__to_change(row) for row in cur])
+        return changes
+
+    @__reader__
     def get_by_commit_id(self, commit_id: str):
         cur = self.conn.cursor()
         cur.execute(
-            'SELECT data from tbl_changes where commit_id = ?',
-            (commit_id),
+            'SELECT %s from tbl_changes where commit_id = ?' % (self.COLUMNS),
+            (commit_id, ),
         )
         row = cur.fetchone()
-        return json.loads(row[0]) if row else None
+        return self.__to_change(row) if row else None
+
+    @__reader__
+    def get_raw(self, number: str, profile: int = 0):
+        # json of a change as fetched, None if the row was fetched without
+        # some options of `profile`
+        cur = self.conn.cursor()
+        cur.execute('SELECT data, profile from tbl_changes where number = ?',
+                    (int(number), ))
+        row = cur.fetchone()
+        if row is None or Gerrit.data_mask(profile) & ~row[1] != 0:
+            return None
+        return self.__load(row[0])
+
+    def get_changes_between(self, project: str, branch: str, query: str,
+                            since: int, until: int, chunk_size: int = 1000):
+        # Streamed newest first in chunks, a pooled connection is only held
+        # while a chunk is read and not while the caller works on it.
+        number = 1 << 62
+        while True:
+            changes = self.__get_changes_chunk(project, branch, query, since,
+                                               until, number, chunk_size)
+            yield from changes
+            if len(changes) < chunk_size:
+                return
+            until = changes[-1].updated // NS
+            number = changes[-1].number
+
+    @__reader__
+    def __get_changes_chunk(self, project: str, branch: str, query: str,
+                            since: int, until: int, number: int, limit: int):
+        # the next `limit` changes after (`until`, `number`)
+        cur = self.conn.cursor()
+        cur.execute(
+            '''SELECT %s from tbl_changes where
+                       project = ? and branch = ?
+                       and update_time >= ? and update_time <= ?
+                       and (update_time < ? or number < ?) %s
+                       ORDER BY update_time DESC, number DESC LIMIT ?''' %
+            (self.COLUMNS, self.QUERIES[query]),
+            (project, branch, since, until, until, number, limit))
+        return [self.__to_change(row) for row in cur]
+
+    @__reader__
+    def walk_history(self, project: str, commit_id: str, since: int,
+                     until: int):
+        # Merged changes on the first parent chain of `commit_id`, newest
+        # first, down to the first one updated before `since`. None if the
+        # chain reaches a commit that is not indexed.
+        cur = self.conn.cursor()
+        cur.execute(
+            '''WITH RECURSIVE walk(id, next, num, time, depth) AS (
+                    SELECT c.commit_id, c.parent, c.number, t.update_time, 0
+                    from tbl_commits c JOIN tbl_changes t ON t.number = c.number
+                    where c.commit_id = ? and c.project = ?
+                    UNION ALL
+                    SELECT c.commit_id, c.parent, c.number, t.update_time,
+                           walk.depth + 1
+                    from walk JOIN tbl_commits c ON c.commit_id = walk.next
+                    JOIN tbl_changes t ON t.number = c.number
+                    where walk.time >= ? and c.project = ?
+                )
+                SELECT %s, walk.next from walk
+                JOIN tbl_changes ON tbl_changes.number = walk.num
+                ORDER BY walk.depth''' % (self.COLUMNS),
+            (commit_id, project, since, project))
+        changes = []
+        next = commit_id
+        for row in cur.fetchall():
+            change = self.__to_change(row[:-1])
+            if change.updated // NS < since:
+                return changes
+            if change.updated // NS <= until:
+                changes.append(change)
+            next = row[-1]
+        return changes if next is None else None
+
+    @__reader__
+    def get_branch_head(self, project: str, branch: str):
+        # commit of the newest merged change of the branch that no other
+        # merged change of the branch has as its parent
+        cur = self.conn.cursor()
+        cur.execute(
+            '''SELECT commit_id from tbl_changes c where
+                       project = ? and branch = ? and status = 'MERGED'
+                       and commit_id IS NOT NULL and NOT EXISTS (
+                        SELECT 1 from tbl_changes n where n.project = c.project
+                        and n.branch = c.branch and n.status = 'MERGED'
+                        and n.parent = c.commit_id)
+                       ORDER BY update_time DESC, number DESC LIMIT 1''',
+            (project, branch))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    @__reader__
+    def is_ancestor(self, commit_id: str, head: str):
+        # True if `commit_id` is reachable from `head` through both parents
+        # of the indexed commits
+        cur = self.conn.cursor()
+        cur.execute(
+            '''WITH RECURSIVE reach(id) AS (
+                    VALUES(?)
+                    UNION
+                    SELECT CASE side.n WHEN 1 THEN c.parent ELSE c.parent2 END
+                    from reach JOIN tbl_commits c ON c.commit_id = reach.id,
+                    (SELECT 1 AS n UNION ALL SELECT 2) side
+                )
+                SELECT 1 from reach where id = ? LIMIT 1''', (head, commit_id))
+        return cur.fetchone() is not None
+
+    @__reader__
+    def get_patch_ids(self, commit_ids: List[str]):
+        # patch id by commit id of the fingerprinted commits
+        cur = self.conn.cursor()
+        patch_ids = {}
+        for index in range(0, len(commit_ids), 500):
+            chunk = commit_ids[index:index + 500]
+            cur.execute(
+                'SELECT commit_id, patch_id from tbl_patches where commit_id IN (%s)' %
+                (', '.join(['?'] * len(chunk))), chunk)
+            patch_ids.update(cur.fetchall())
+        return patch_ids
+
+    @__writer__
+    def add_patch_ids(self, rows: List[tuple]):
+        # (commit_id, project, patch_id), a revision never changes its diff
+        cur = self.conn.cursor()
+        cur.executemany(
+            '''INSERT OR IGNORE INTO tbl_patches (commit_id, project, patch_id)
+                values (?, ?, ?)''', rows)
+        self.conn.commit()
+
+    @__reader__
+    def get_cherry_pick_by_patch_id(self, project: str, patch_id: str,
+                                    number: str, branch_to: str = None):
+        cur = self.conn.cursor()
+        args = [project, patch_id, int(number)]
+        branch = ''
+        if branch_to:
+            branch = 'and branch = ?'
+            args.append(branch_to)
+        cur.execute(
+            '''SELECT %s from tbl_changes where commit_id IN
+                       (SELECT commit_id from tbl_patches where
+                        project = ? and patch_id = ?)
+                       and number != ? and status != 'ABANDONED' %s''' %
+            (self.COLUMNS, branch), args)
+        changes = []
+        for row in cur.fetchall():
+            changes.append(self.__to_change(row))
+        return changes
+
+    @__reader__
+    def get_coverage(self, project: str, branch: str, query: str):
+        cur = self.conn.cursor()
+        cur.execute(
+            '''SELECT since, until, fetched from tbl_coverage where
+                       project = ? and branch = ? and query = ?
+                       ORDER BY since''', (project, branch, query))
+        return cur.fetchall()
+
+    @__writer__
+    def add_coverage(self, project: str, branch: str, query: str, since: int,
+                     until: int, fetched: int):
+        # merge the new range with the overlapping or adjacent ones
+        ranges = []
+        for item in sorted(self.get_coverage(project, branch, query) +
+                           [(since, until, fetched)]):
+            if len(ranges) > 0 and item[0] <= ranges[-1][1] + 1:
+                last = ranges[-1]
+                ranges[-1] = (last[0], max(last[1], item[1]), min(last[2], item[2]))
+            else:
+                ranges.append(item)
+
+        cur = self.conn.cursor()
+        cur.execute(
+            'DELETE from tbl_coverage where project = ? and branch = ? and query = ?',
+            (project, branch, query))
+        cur.executemany(
+            '''INSERT INTO tbl_coverage (project, branch, query, since, until, fetched)
+                values (?, ?, ?, ?, ?, ?)''',
+            [(project, branch, query) + item for item in ranges])
+        self.conn.commit()
+
+    @__reader__
+    def get_sync(self, project: str, branch: str):
+        cur = self.conn.cursor()
+        cur.execute(
+            'SELECT updated from tbl_sync where project = ? and branch = ?',
+            (project, branch))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    @__writer__
+    def set_sync(self, project: str, branch: str, updated: str):
+        cur = self.conn.cursor()
+        cur.execute(
+            '''INSERT OR REPLACE INTO tbl_sync (project, branch, updated)
+                values (?, ?, ?)''', (project, branch, updated))
+        self.conn.commit()
 
     def get_by_id(self, id: str):
         items = id.split("~")
         return self.get(items[0].replace("%2F", "/"), items[1], items[2])
 
+    @__reader__
     def get_cherry_pick(self, project: str, change_id: str, number: str):
         cur = self.conn.cursor()
         cur.execute(
-            '''SELECT data from tbl_changes where
+            '''SELECT %s from tbl_changes where
                        project = ? and change_id = ? and number != ?
-                       and status != 'ABANDONED' ''', (
+                       and status != 'ABANDONED' ''' % (self.COLUMNS), (
                 project,
                 change_id,
                 int(number),
             ))
         changes = []
         for row in cur.fetchall():
-            changes.append(json.loads(row[0]))
+            changes.append(self.__to_change(row))
         return changes
 
+    @__reader__
     def get_cherry_pick_to(self, project: str, change_id: str, number: str,
                            branch_to: str):
         cur = self.conn.cursor()
         cur.execute(
-            '''SELECT data from tbl_changes where
+            '''SELECT %s from tbl_changes where
                        project = ? and change_id = ? and number != ?
                        and status != 'ABANDONED'
-                       and branch = ? ''',
+                       and branch = ? ''' % (self.COLUMNS),
             (project, change_id, int(number), branch_to))
         changes = []
         for row in cur.fetchall():
-            changes.append(json.loads(row[0]))
+            changes.append(self.__to_change(row))
         return changes
 
 
+class ChangeIndex:
+    # The rows of tbl_changes per (project, branch) in memory, for a resident
+    # process answering many reports. A branch is read from the cache on its
+    # first query and from then on follows the rows written to the cache.
+    cache: GerritCache = None
+    loads: int = None
+    hits: int = None
+    updates: int = None
+
+    # the QUERIES of GerritCache
+    FILTERS = {
+        '': lambda chg: True,
+        'is:merged': lambda chg: chg.status == 'MERGED',
+        'status:merged': lambda chg: chg.status == 'MERGED',
+        '-is:abandoned': lambda chg: chg.status != 'ABANDONED',
+    }
+
+    def __init__(self, cache: GerritCache):
+        self.cache = cache
+        self.loads = 0
+        self.hits = 0
+        self.updates = 0
+        # {number: change} and the changes sorted by (updated, number) along
+        # with their times, sorted again after an update
+        self.__changes = {}
+        self.__sorted = {}
+        self.__lock = threading.Lock()
+        cache.listeners.append(self.update)
+
+    def get_changes_between(self, project: str, branch: str, query: str,
+                            since: int, until: int):
+        # same rows and order as GerritCache.get_changes_between
+        key = (project, branch)
+        with self.__lock:
+            if key not in self.__changes:
+                self.__changes[key] = {
+                    chg.number: chg for chg in self.cache.get_changes_between(
+                        project, branch, '', 0, 1 << 62)}
+                self.__sorted[key] = None
+                self.loads += 1
+            else:
+                self.hits += 1
+            if self.__sorted[key] is None:
+                changes = sorted(self.__changes[key].values(),
+                                 key=lambda chg: (chg.updated, chg.number))
+                self.__sorted[key] = ([chg.updated for chg in changes], changes)
+            times, changes = self.__sorted[key]
+        changes = changes[bisect.bisect_left(times, since * NS):
+                          bisect.bisect_right(times, until * NS)]
+        accept = self.FILTERS[query]
+        return [chg for chg in reversed(changes) if accept(chg)]
+
+    def update(self, written: List[tuple]):
+        # the rows are read back as the cache keeps them, e.g. a merged
+        # change is not overwritten
+        with self.__lock:
+            numbers = [number for number, project, branch in written
+                       if (project, branch) in self.__changes]
+            if len(numbers) == 0:
+                return
+            for chg in self.cache.get_by_numbers(numbers):
+                key = (chg.project, chg.branch)
+                self.__changes[key][chg.number] = chg
+                self.__sorted[key] = None
+            self.updates += len(numbers)
+
+
 class GerritCached(Gerrit):
     cache: GerritCache = None
+    # answers the cached ranges instead of the cache when set
+    index: ChangeIndex = None
     cache_match: int = None
     cache_miss: int = None
     only_cache: bool = None
+    coverage_trust: int = None
+    match_patches: bool = None
+    # what the rows in the cache were fetched with is remembered per row
+    default_profile: str = 'full'
+    commit_index: bool = True
 
     def __init__(self,
                  cache,
@@ -333,18 +1852,37 @@ class GerritCached(Gerrit):
                  password,
                  insecure: bool = True,
                  verbose: bool = False,
-                 only_cache: bool = False):
-        super().__init__(host, user, password, insecure, verbose)
+                 only_cache: bool = False,
+                 pool_size: int = 4,
+                 pool: ConnectionPool = None,
+                 batch_size: int = 50,
+                 page_size: int = 500,
+                 coverage_trust: int = 0,
+                 responses: ResponseCache = None,
+                 tracer: Tracer = None,
+                 match_patches: bool = False,
+                 limiter: RateLimiter = None,
+                 retries: int = 3,
+                 timeout: float = 60):
+        super().__init__(host, user, password, insecure, verbose, pool_size,
+                         pool, batch_size, page_size, responses, tracer,
+                         limiter, retries, timeout)
         self.cache = cache
         self.cache_match = 0
         self.cache_miss = 0
         self.only_cache = only_cache
+        self.coverage_trust = coverage_trust
+        self.match_patches = match_patches
 
     def __update_cache(self, changes):
         if not isinstance(changes, list):
             self.cache.update(changes)
+            changes = [changes]
         else:
             self.cache.update_list(changes)
+        # the json is in the cache now, the records keep the fields only
+        for chg in changes:
+            chg.data = None
 
     def __cache__(func):
         def __decorated_update_cache(self, *args, **kwargs):
@@ -357,13 +1895,172 @@ class GerritCached(Gerrit):
 
         return __decorated_update_cache
 
-    def search(self, path, search: List[str], queries: List[str] = []):
-        return super().search(path, search, queries + ['O=a'])
+    def get_change_data(self, number: str, profile: str = 'full'):
+        # full json of a change, refetched when the cached one was fetched
+        # with fewer options than `profile`
+        change = self.cache.get_raw(number, self.profile_mask(profile))
+        if change is not None or self.only_cache:
+            self.cache_match += 1
+            return change
+        # the fetched json goes to the cache and is read back from there
+        self.query_changes(['change:%s' % (number)], [self.options(profile)])
+        return self.cache.get_raw(number, self.profile_mask(profile))
+
+    @staticmethod
+    def __coverage_key(search: List[str], queries: List[str]):
+        project = [s for s in search if s.startswith('project:')]
+        branch = [s for s in search if s.startswith('branch:')]
+        others = sorted([s for s in search if s not in project + branch])
+        query = ' '.join(others)
+        if len(project) != 1 or len(branch) != 1 or \
+            query not in GerritCache.QUERIES or \
+            len([q for q in queries if not q.startswith('O=')]) > 0:
+            return None
+        return project[0][len('project:'):], branch[0][len('branch:'):], query
+
+    def iter_changes_between(self,
+                             search: List[str],
+                             queries: List[str],
+                             since: str = None,
+                             until: str = None,
+                             refresh: bool = False):
+        # Ranges already fetched for this (project, branch, query) are read
+        # from the cache, only the gaps go to gerrit. `refresh` fetches the
+        # whole range and streams it from gerrit.
+        key = self.__coverage_key(search, queries)
+        if key is None:
+            yield from super().iter_changes_between(search, queries, since, until)
+            return
+
+        project, branch, query = key
+        now = int(time.time())
+        since_ts = self.time_epoch(since) if since else 0
+        until_ts = self.time_epoch(until) if until else now
+
+        def fetch(gap_since: int, gap_until: int):
+            intact = yield from super(GerritCached, self).iter_changes_between(
+                search, queries,
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(gap_since)),
+                time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(gap_until)))
+            if not intact:
+                # a resumed page may have missed changes, fetched again
+                # next time
+                return
+            # the last `coverage_trust` seconds are fetched again next time
+            gap_until = min(gap_until, now - self.coverage_trust)
+            if gap_until > gap_since:
+                self.cache.add_coverage(project, branch, query, gap_since,
+                                        gap_until, now)
+
+        if refresh:
+            yield from fetch(since_ts, until_ts)
+            return
+
+        # the rows of the unfiltered query(update-cache) answer every filter
+        coverage = self.cache.get_coverage(project, branch, query)
+        if query != '':
+            coverage = sorted(coverage + self.cache.get_coverage(project, branch, ''))
+
+        # the range split in covered parts and gaps, (since, until, gap)
+        parts = []
+        start = since_ts
+        for cover_since, cover_until, _ in coverage:
+            if cover_until < start or cover_since > until_ts:
+                continue
+            if cover_since > start:
+                parts.append((start, cover_since, True))
+            parts.append((max(start, cover_since), min(cover_until, until_ts), False))
+            start = max(start, cover_until)
+        if start < until_ts:
+            parts.append((start, until_ts, True))
+
+        rows = self.cache if self.index is None else self.index
+        if self.only_cache or not any(gap for _, _, gap in parts):
+            self.cache_match += 1
+            yield from rows.get_changes_between(project, branch, query,
+                                                since_ts, until_ts)
+            return
+
+        # newest first, a gap streams from gerrit as its pages arrive;
+        # the parts share their bounds, and a merged change commented on
+        # later is in the cache with its older time
+        seen = set()
+        for part_since, part_until, gap in reversed(parts):
+            if gap:
+                changes = fetch(part_since, part_until)
+            else:
+                changes = rows.get_changes_between(project, branch, query,
+                                                   part_since, part_until)
+            for chg in changes:
+                if chg.number not in seen:
+                    seen.add(chg.number)
+                    yield chg
+
+    def walk_history(self,
+                     search: List[str],
+                     queries: List[str],
+                     commit_id: str,
+                     since: str = None,
+                     until: str = None):
+        # The history below a fork point never changes, it is read from the
+        # commit index instead of querying the ancestor branches.
+        project = [s for s in search if s.startswith('project:')]
+        others = [s for s in search if s not in project]
+        if len(project) != 1 or others not in (['is:merged'], ['status:merged']) or \
+            len([q for q in queries if not q.startswith('O=')]) > 0:
+            return None
+        changes = self.cache.walk_history(
+            project[0][len('project:'):], commit_id,
+            self.time_epoch(since) if since else 0,
+            self.time_epoch(until) if until else int(time.time()))
+        if changes is not None:
+            self.cache_match += 1
+        return changes
+
+    def is_reachable(self, commit_id: str, project: str, branch: str):
+        # Whether `commit_id` is in the history of the cached head of the
+        # branch, answered from the commit index; None without a head
+        head = self.cache.get_branch_head(project, branch)
+        if head is None:
+            return None
+        return self.cache.is_ancestor(commit_id, head)
+
+    def get_patch_ids(self, changes: List):
+        # Fingerprints are computed once per revision and kept in the cache,
+        # None for changes not fingerprinted yet with `only_cache`.
+        changes = [chg for chg in changes if chg.revision is not None]
+        patch_ids = self.cache.get_patch_ids([chg.revision for chg in changes])
+        missing = list({chg.revision: chg for chg in changes
+                        if chg.revision not in patch_ids}.values())
+        self.cache_match += len(changes) - len(missing)
+        if len(missing) > 0 and not self.only_cache:
+            self.cache_miss += len(missing)
+            fetched = super().get_patch_ids(missing)
+            self.cache.add_patch_ids([(chg.revision, chg.project, id)
+                                      for chg, id in zip(missing, fetched)])
+            patch_ids.update(zip([chg.revision for chg in missing], fetched))
+        return [patch_ids.get(chg.revision) for chg in changes]
 
     @__cache__
     def query_changes(self, search: List[str], queries: List[str] = []):
         self.cache_miss += 1
-        return self.search('/changes/', search, queries)
+        return super().query_changes(search, queries)
+
+    def iter_query_changes(self, search: List[str], queries: List[str] = []):
+        # written to the cache in batches while the response is decoded
+        self.cache_miss += 1
+        changes = []
+        try:
+            for chg in super().iter_query_changes(search, queries):
+                changes.append(chg)
+                if len(changes) >= 100:
+                    self.__update_cache(changes)
+                    changes = []
+                yield chg
+        finally:
+            # also when the response breaks off, the caller resumes after
+            # the changes yielded so far
+            self.__update_cache(changes)
 
     @__cache__
     def get_change(self, id: str):
@@ -374,21 +2071,322 @@ class GerritCached(Gerrit):
         self.cache_miss += 1
         return super().get_change(id)
 
-    def get_change_cherry_pick(self, change, branch_to: str = None):
+    def __get_cached_cherry_pick(self, change, branch_to: str = None):
         if branch_to:
-            changes = self.cache.get_cherry_pick_to(change['project'],
-                                                    change['change_id'],
-                                                    change['_number'],
-                                                    branch_to)
+            return self.cache.get_cherry_pick_to(change.project,
+                                                 change.change_id,
+                                                 change.number,
+                                                 branch_to)
+        return self.cache.get_cherry_pick(change.project,
+                                          change.change_id,
+                                          change.number)
+
+    def get_change_cherry_pick(self, change, branch_to: str = None):
+        return self.get_changes_cherry_pick([change], branch_to)[0]
+
+    def get_changes_cherry_pick(self, changes: List, branch_to: str = None):
+        results = []
+        missing = []
+        for change in changes:
+            cherries = self.__get_cached_cherry_pick(change, branch_to)
+            if len(cherries) > 0 or self.only_cache:
+                self.cache_match += 1
+            else:
+                missing.append(change)
+                cherries = None
+            results.append(cherries)
+
+        if len(missing) > 0:
+            self.cache_miss += len(missing)
+            fetched = super().get_changes_cherry_pick(missing, branch_to)
+            self.__update_cache([chg for cherries in fetched for chg in cherries])
+
+            fetched = iter(fetched)
+            results = [
+                cherries if cherries is not None else next(fetched)
+                for cherries in results
+            ]
+
+        if self.match_patches:
+            # picked with another Change-Id, looked up among the fingerprinted
+            # changes
+            unmatched = [index for index, cherries in enumerate(results)
+                         if len(cherries) == 0 and changes[index].revision is not None]
+            patch_ids = self.get_patch_ids([changes[index] for index in unmatched])
+            for index, id in zip(unmatched, patch_ids):
+                if id is not None:
+                    results[index] = self.cache.get_cherry_pick_by_patch_id(
+                        changes[index].project, id, changes[index].number, branch_to)
+        return results
+
+
+class AsyncGerrit:
+    gerrit: Gerrit = None
+    jobs: int = None
+
+    def __init__(self, gerrit: Gerrit, jobs: int = 4):
+        self.gerrit = gerrit
+        self.jobs = max(1, jobs)
+        # the executor bounds the number of requests in flight
+        self.__executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix='gerrit')
+        # branch queries in flight, shared by the reports that ask for them;
+        # every report runs its own event loop, the executor futures are
+        # awaited from any of them
+        self.__branch_queries = {}
+        self.__branch_lock = threading.Lock()
+
+    async def __call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor,
+                                          functools.partial(func, *args))
+
+    async def map(self, func, items: List[tuple]):
+        # results are returned in the order of `items`
+        return await asyncio.gather(*[self.__call(func, *args) for args in items])
+
+    def run(self, *aws):
+        async def gather():
+            return await asyncio.gather(*aws)
+
+        return asyncio.run(gather())
+
+    def close(self):
+        self.__executor.shutdown()
+
+    async def query_changes(self, search: List[str], queries: List[str] = []):
+        return await self.__call(self.gerrit.query_changes, search, queries)
+
+    async def query_changes_between(self,
+                                    search: List[str],
+                                    queries: List[str],
+                                    since: str = None,
+                                    until: str = None):
+        return await self.__call(self.gerrit.query_changes_between, search,
+                                 queries, since, until)
+
+    async def query_changes_between_branches(self,
+                                             search: List[str],
+                                             queries: List[str],
+                                             branches: List[str],
+                                             since: str = None,
+                                             until: str = None):
+        # All branches are fetched over the full range at once, the fork
+        # point filter of splice_branch drops what the serial version would
+        # have excluded by narrowing `until`.
+        return (await self.query_changes_between_graphs(
+            search, queries, [branches], since, until))[0]
+
+    async def __query_branches(self,
+                               search: List[str],
+                               queries: List[str],
+                               names: List[str],
+                               since: str = None,
+                               until: str = None):
+        aws = []
+        for name in names:
+            new_search = search.copy()
+            new_search.append('branch:%s' % (name))
+            aws.append(self.__query_branch(new_search, queries, since, until))
+        return dict(zip(names, await asyncio.gather(*aws)))
+
+    async def __query_branch(self,
+                             search: List[str],
+                             queries: List[str],
+                             since: str = None,
+                             until: str = None):
+        # e.g. the source branch of a report that is also the ancestor of its
+        # target, asked again before the first query is done
+        key = (tuple(search), tuple(queries), since, until)
+        submitted = False
+        with self.__branch_lock:
+            future = self.__branch_queries.get(key)
+            if future is None:
+                future = self.__executor.submit(self.gerrit.query_changes_between,
+                                                search, queries, since, until)
+                self.__branch_queries[key] = future
+                submitted = True
+        if submitted:
+            # outside of the lock, a future already done calls back at once
+            future.add_done_callback(functools.partial(self.__query_done, key))
+        return await asyncio.wrap_future(future)
+
+    def __query_done(self, key: tuple, future):
+        with self.__branch_lock:
+            if self.__branch_queries.get(key) is future:
+                del self.__branch_queries[key]
+
+    async def query_changes_between_graphs(self,
+                                           search: List[str],
+                                           queries: List[str],
+                                           graphs: List[List[str]],
+                                           since: str = None,
+                                           until: str = None):
+        # Like query_changes_between_branches for several branch graphs, a
+        # branch shared by some graphs (e.g. their common ancestors) is only
+        # fetched once. With a commit index only the last branch of each
+        # graph is fetched first, the ancestors are walked from its fork
+        # point and only fetched where the walk leaves the index.
+        if self.gerrit.commit_index:
+            # a branch missing from the branch config has an empty graph
+            names = [graph[-1] for graph in graphs if len(graph) > 0]
         else:
-            changes = self.cache.get_cherry_pick(change['project'],
-                                                 change['change_id'],
-                                                 change['_number'])
-        if len(changes) > 0 or self.only_cache:
-            self.cache_match += 1
-            return changes
-        #self.cache_miss += 1
-        return super().get_change_cherry_pick(change, branch_to)
+            names = [name for graph in graphs for name in graph]
+        results = await self.__query_branches(
+            search, queries, list(dict.fromkeys(names)), since, until)
+
+        walks = []
+        for graph in graphs:
+            walk = None
+            if len(graph) > 1 and self.gerrit.commit_index:
+                _, parent_id = Gerrit.splice_branch([], results[graph[-1]])
+                if parent_id is not None:
+                    walk = await self.__call(self.gerrit.walk_history, search,
+                                             queries, parent_id, since, until)
+            walks.append(walk)
+
+        names = [name for graph, walk in zip(graphs, walks) if walk is None
+                 for name in graph if name not in results]
+        results.update(await self.__query_branches(
+            search, queries, list(dict.fromkeys(names)), since, until))
+
+        histories = []
+        for graph, walk in zip(graphs, walks):
+            changes = []
+            parent_id = None
+            for name in reversed(graph if walk is None else graph[-1:]):
+                _, parent_id = Gerrit.splice_branch(changes, results[name], parent_id)
+            if walk is not None:
+                Gerrit.splice_branch(changes, walk)
+            histories.append(changes)
+        return histories
+
+    async def get_change(self, id: str):
+        return await self.__call(self.gerrit.get_change, id)
+
+    async def get_change_detail(self, id: str):
+        return await self.__call(self.gerrit.get_change_detail, id)
+
+    async def get_change_cherry_pick(self, change, branch_to: str = None):
+        return await self.__call(self.gerrit.get_change_cherry_pick, change,
+                                 branch_to)
+
+    async def get_patch_ids(self, changes: List):
+        size = self.gerrit.batch_size
+        batches = await self.map(self.gerrit.get_patch_ids,
+                                 [(changes[index:index + size], )
+                                  for index in range(0, len(changes), size)])
+        return [id for batch in batches for id in batch]
+
+    async def get_changes_cherry_pick(self, changes: List, branch_to: str = None):
+        size = self.gerrit.batch_size
+        batches = await self.map(self.gerrit.get_changes_cherry_pick,
+                                 [(changes[index:index + size], branch_to)
+                                  for index in range(0, len(changes), size)])
+        return [cherries for batch in batches for cherries in batch]
+
+
+class EventIngester:
+    gerrit: Gerrit = None
+    delay: float = None
+    received: int = None
+    ignored: int = None
+    refreshed: int = None
+
+    # events that change what a cached change looks like
+    TYPES = ('change-merged', 'patchset-created', 'change-abandoned')
+
+    def __init__(self, gerrit: Gerrit, delay: float = 2.0):
+        # Events of the webhooks plugin or `stream-events` refresh the changes
+        # they name, a burst is coalesced for `delay` seconds and fetched in
+        # OR-ed queries of `batch_size` changes, written to the cache in one
+        # batch per query.
+        self.gerrit = gerrit
+        self.delay = delay
+        self.received = 0
+        self.ignored = 0
+        self.refreshed = 0
+        self.__pending = set()
+        self.__first = None
+        self.__cond = threading.Condition()
+
+    def add(self, event):
+        change = event.get('change') if isinstance(event, dict) else None
+        with self.__cond:
+            if not isinstance(change, dict) or 'number' not in change or \
+                event.get('type') not in self.TYPES:
+                self.ignored += 1
+                return False
+            self.received += 1
+            if len(self.__pending) == 0:
+                self.__first = time.monotonic()
+            self.__pending.add(int(change['number']))
+            self.__cond.notify()
+        return True
+
+    def add_text(self, text: str):
+        # one event, a json array of events or one event per line
+        try:
+            events = json.loads(text)
+        except ValueError:
+            events = []
+            for line in text.splitlines():
+                if line.strip() == '':
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logging.warning('Bad event: %s' % (line[:80]))
+                    events.append(None)
+        if not isinstance(events, list):
+            events = [events]
+        return len([event for event in events if self.add(event)])
+
+    def flush(self):
+        with self.__cond:
+            numbers = sorted(self.__pending)
+            self.__pending = set()
+        size = self.gerrit.batch_size
+        for index in range(0, len(numbers), size):
+            chunk = numbers[index:index + size]
+            try:
+                changes = self.gerrit.query_changes(
+                    ['(%s)' % (' OR '.join(['change:%d' % (n) for n in chunk]))],
+                    [self.gerrit.options('cache')])
+            except Exception:
+                # fetched again with the next burst
+                with self.__cond:
+                    if len(self.__pending) == 0:
+                        self.__first = time.monotonic()
+                    self.__pending.update(numbers[index:])
+                raise
+            self.refreshed += len(changes)
+            logging.debug('Events: refreshed %d changes' % (len(changes)))
+        return len(numbers)
+
+    def run(self, stop: threading.Event):
+        # flush coalesced bursts until `stop` is set, then the rest
+        while not stop.is_set():
+            with self.__cond:
+                while len(self.__pending) == 0 and not stop.is_set():
+                    self.__cond.wait(1)
+                while len(self.__pending) < self.gerrit.batch_size and \
+                    not stop.is_set():
+                    left = self.__first + self.delay - time.monotonic()
+                    if left <= 0:
+                        break
+                    self.__cond.wait(left)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error('Events: refresh failed: %s' % (e))
+                stop.wait(self.delay)
+        self.flush()
+
+    def stop(self, stop: threading.Event):
+        stop.set()
+        with self.__cond:
+            self.__cond.notify()
 
 
 class BranchGraph:
@@ -396,11 +2394,18 @@ class BranchGraph:
 
     def __init__(self, config):
         self.config = config
+        self.__times = {}
+
+    def __timestamp(self, text: str):
+        # create times are compared many times, parse each once
+        if text not in self.__times:
+            self.__times[text] = parse_time_ns(text)
+        return self.__times[text]
 
     def get_since(self, branch: str):
         time = ''
         if branch in self.config:
-            if create_time in self.config[branch]:
+            if 'create_time' in self.config[branch]:
                 time = self.config[branch]['create_time']
         if time != '':
             return time
@@ -420,7 +2425,7 @@ class BranchGraph:
 
         if index < len(graph_1) and index < len(graph_2):
             # return the smaller one
-            if timestamp(graph_1[index]['time']) <= timestamp(graph_2[index]['time']):
+            if self.__timestamp(graph_1[index]['time']) <= self.__timestamp(graph_2[index]['time']):
                 return graph_1[index]['time']
             else:
                 return graph_2[index]['time']
@@ -444,7 +2449,7 @@ class BranchGraph:
 
         if index < len(graph_1) and index < len(graph_2):
             # return the smaller one
-            if timestamp(graph_1[index]['time']) <= timestamp(graph_2[index]['time']):
+            if self.__timestamp(graph_1[index]['time']) <= self.__timestamp(graph_2[index]['time']):
                 graph_2[index]['time'] = graph_1[index]['time']
                 return graph_1[index::], graph_2[index::]
             else:
@@ -469,76 +2474,308 @@ class BranchGraph:
                 break
         return graph
 
+class ChangeMatcher:
+    revisions: set = None
+    change_ids: Dict[str, List] = None
+    patch_ids: Dict[str, str] = None
+    patches: Dict[str, List] = None
+
+    def __init__(self, target_changes: List, patch_ids: Dict[str, str] = {}):
+        # `patch_ids` are the fingerprints by revision of the source and
+        # target changes that may have been picked with another Change-Id
+        self.revisions = set()
+        self.change_ids = {}
+        self.patch_ids = patch_ids
+        self.patches = {}
+        for chg in target_changes:
+            self.revisions.add(chg.revision)
+            self.change_ids.setdefault(chg.change_id, []).append(chg)
+            if chg.revision in patch_ids:
+                self.patches.setdefault(patch_ids[chg.revision], []).append(chg)
+
+    def find_end(self, changes: List):
+        # index of the newest source change that is already in the target
+        for index, chg in enumerate(changes):
+            if chg.revision in self.revisions:
+                return index
+        return len(changes)
+
+    def get_cherry_picks(self, change, branch_to: str = None):
+        # picks on any other branch, or on `branch_to` only
+        cherries = [
+            chg for chg in self.change_ids.get(change.change_id, [])
+            if chg.branch != change.branch and branch_to in (None, chg.branch)
+        ]
+        if len(cherries) == 0 and change.revision in self.patch_ids:
+            cherries = [
+                chg for chg in self.patches.get(self.patch_ids[change.revision], [])
+                if chg.branch != change.branch and chg.number != change.number
+                and branch_to in (None, chg.branch)
+            ]
+        return cherries
+
+
+class Renderer:
+    # Writes a report table to `out` as the rows are found, every row with a
+    # single write. A cell is a text or a list of (change, local, branch)
+    # entries: `local` shows the committer date in local time, `branch`
+    # labels a change that is not on the branch of its column.
+    ext: str = None
+    content_type: str = None
+    out = None
+    url_for_change = None
+
+    def __init__(self, out, url_for_change):
+        self.out = out
+        self.url_for_change = url_for_change
+
+    def date(self, change: Change, local: bool):
+        if local:
+            return local_time(change.committer_date)
+        return gerrit_time(change.committer_date)
+
+    def begin(self, title: str, columns: List[str]):
+        pass
+
+    def row(self, cells: List):
+        pass
+
+    def end(self):
+        pass
+
+
+class MarkdownRenderer(Renderer):
+    ext = 'md'
+    content_type = 'text/markdown'
+
+    @staticmethod
+    def escape(s: str):
+        return html.escape(s).replace("[", "\\[").replace("]", "\\]").replace(
+            "(", "\\(").replace(")", "\\)")
+
+    def begin(self, title: str, columns: List[str]):
+        self.out.write('# %s\n| %s | \n|%s\n' %
+                       (title, ' | '.join(columns), '----|' * len(columns)))
+
+    def cell(self, cell):
+        if isinstance(cell, str):
+            return '*%s*' % (cell)
+        items = []
+        for change, local, branch in cell:
+            item = '<a href="%s">%s</a> - **%s**/%s' % (
+                self.url_for_change(change.number), self.escape(change.subject),
+                change.author, self.date(change, local))
+            if branch is not None:
+                item = '<font color="red">**%s**</font></br> %s' % (branch, item)
+            items.append(item)
+        return '</br>'.join(items)
+
+    def row(self, cells: List):
+        self.out.write('| %s |\n' % (' | '.join([self.cell(cell) for cell in cells])))
+
+
+class HtmlRenderer(Renderer):
+    ext = 'html'
+    content_type = 'text/html'
+
+    def begin(self, title: str, columns: List[str]):
+        self.out.write(
+            '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>%s</title>\n</head>\n<body>\n<h1>%s</h1>\n<table border="1">\n'
+            '<tr>%s</tr>\n' % (html.escape(title), html.escape(title), ''.join(
+                ['<th>%s</th>' % (html.escape(column)) for column in columns])))
+
+    def cell(self, cell):
+        if isinstance(cell, str):
+            return '<i>%s</i>' % (html.escape(cell))
+        items = []
+        for change, local, branch in cell:
+            item = '<a href="%s">%s</a> - <b>%s</b>/%s' % (
+                html.escape(self.url_for_change(change.number)),
+                html.escape(change.subject), html.escape(change.author or ''),
+                self.date(change, local))
+            if branch is not None:
+                item = '<font color="red"><b>%s</b></font><br> %s' % (html.escape(branch), item)
+            items.append(item)
+        return '<br>'.join(items)
+
+    def row(self, cells: List):
+        self.out.write('<tr>%s</tr>\n' % (''.join(
+            ['<td>%s</td>' % (self.cell(cell)) for cell in cells])))
+
+    def end(self):
+        self.out.write('</table>\n</body>\n</html>\n')
+
+
+class CsvRenderer(Renderer):
+    ext = 'csv'
+    content_type = 'text/csv'
+
+    def __init__(self, out, url_for_change):
+        super().__init__(out, url_for_change)
+        self.writer = csv.writer(out, lineterminator='\n')
+
+    def cell(self, cell):
+        if isinstance(cell, str):
+            return cell
+        return '\n'.join([
+            '%s%s %s - %s/%s' % ('[%s] ' % (branch) if branch is not None else '',
+                                 self.url_for_change(change.number), change.subject,
+                                 change.author, self.date(change, local))
+            for change, local, branch in cell
+        ])
+
+    def begin(self, title: str, columns: List[str]):
+        self.writer.writerow(columns)
+
+    def row(self, cells: List):
+        self.writer.writerow([self.cell(cell) for cell in cells])
+
+
+class JsonRenderer(Renderer):
+    ext = 'json'
+    content_type = 'application/json'
+
+    def __init__(self, out, url_for_change):
+        super().__init__(out, url_for_change)
+        self.rows = 0
+
+    def cell(self, cell):
+        if isinstance(cell, str):
+            return cell
+        return [{
+            'number': change.number,
+            'url': self.url_for_change(change.number),
+            'subject': change.subject,
+            'branch': change.branch,
+            'author': change.author,
+            'date': self.date(change, local),
+            'other_branch': branch is not None,
+        } for change, local, branch in cell]
+
+    def begin(self, title: str, columns: List[str]):
+        self.out.write('{"title": %s, "columns": %s, "rows": [' %
+                       (json.dumps(title), json.dumps(columns)))
+
+    def row(self, cells: List):
+        self.out.write('%s\n%s' % (',' if self.rows > 0 else '',
+                                    json.dumps([self.cell(cell) for cell in cells])))
+        self.rows += 1
+
+    def end(self):
+        self.out.write(']}\n')
+
+
+RENDERERS = {
+    'md': MarkdownRenderer,
+    'html': HtmlRenderer,
+    'csv': CsvRenderer,
+    'json': JsonRenderer,
+}
+
+
 class GerritTools:
+    format: str = None
+    match_patches: bool = None
+    tracer: Tracer = None
     cache: GerritCache = None
+    responses: ResponseCache = None
     gerrit: GerritCached = None
+    agerrit: AsyncGerrit = None
     branches: BranchGraph = None
 
     def __init__(self, config, branch_config):
-        self.cache = GerritCache(config.get('cache'))
+        self.format = config.get('format', 'md')
+        self.match_patches = bool(config.get('patch_id'))
+        self.tracer = Tracer(bool(config.get('metrics') or config.get('trace')))
+        self.cache = GerritCache(config.get('cache'),
+                                 config.get('cache_compress', False),
+                                 self.tracer,
+                                 config.get('jobs', 4))
+        if config.get('response_cache_size', 256) > 0:
+            self.responses = ResponseCache(
+                config.get('response_cache'),
+                config.get('response_cache_size', 256) * 1024 * 1024)
         self.gerrit = GerritCached(self.cache, config['host'], config['user'],
                                    config['passwd'], config['insecure'],
                                    config['verbose_http'],
-                                   config.get('only_cache'))
+                                   config.get('only_cache'),
+                                   config.get('pool_size', 4),
+                                   batch_size=config.get('batch_size', 50),
+                                   page_size=config.get('page_size', 500),
+                                   coverage_trust=config.get('coverage_trust', 0) * 3600,
+                                   responses=self.responses,
+                                   tracer=self.tracer,
+                                   match_patches=self.match_patches,
+                                   limiter=RateLimiter(config.get('rate', 0),
+                                                       max(1, int(config.get('rate', 0)))),
+                                   retries=config.get('retries', 3),
+                                   timeout=config.get('timeout', 60))
+        self.agerrit = AsyncGerrit(self.gerrit, config.get('jobs', 4))
         self.branches = BranchGraph(branch_config)
 
-    def __md_escape(self, s: str):
-        return s.replace("[", "\\[").replace("]", "\\]").replace(
-            "(", "\\(").replace(")", "\\)")
+    def renderer(self, out = None, format: str = None):
+        return RENDERERS[format or self.format](out or sys.stdout,
+                                                self.gerrit.url_for_change)
 
     def cherry_pick_list_2(self,
                          project: str,
                          branch: str,
                          branch_to: str,
                          since: str = None,
-                         until: str = None):
+                         until: str = None,
+                         out = None,
+                         format: str = None):
         searches = ['project:%s' % project, 'branch:%s' % branch, 'is:merged']
 
         if since is None or since == '':
             since = self.branches.find_since(branch, branch_to)
 
         logging.debug('Since %s, until %s' %(since, until))
-        changes = self.gerrit.query_changes_between(searches, [], since, until)
-
-        logging.debug('Got %d commits' % (len(changes)))
-
-        print("# %s commits cherry pick list" % (project))
-        print("| %s | %s | " % (branch, branch_to))
-        print("|----|----|")
-
+        changes = self.gerrit.iter_changes_between(
+            searches, [self.gerrit.options('report')], since, until)
+
+        renderer = self.renderer(out, format)
+        renderer.begin('%s commits cherry pick list' % (project), [branch, branch_to])
+
+        # rows are rendered chunk by chunk while the source pages arrive
+        count = 0
+        chunk_size = self.gerrit.batch_size * self.agerrit.jobs
+        for change, cherries in self.__resolve_cherry_picks(changes, branch_to, chunk_size):
+            count += 1
+            cherries = [cherry for cherry in cherries if cherry.branch == branch_to]
+            renderer.row([[(change, True, None)],
+                          [(cherry, True, None) for cherry in cherries[:1]]])
+        renderer.end()
+
+        logging.debug('Got %d commits' % (count))
+        return count
+
+    def __resolve_cherry_picks(self, changes, branch_to: str, chunk_size: int):
+        chunk = []
         for change in changes:
-            print("| ", end="")
-            print(
-                '<a href="%s">%s</a> - **%s**/%s' %
-                (self.gerrit.url_for_change(change['_number']),
-                 self.__md_escape(html.escape(change['subject'])),
-                 change['revisions'][change['current_revision']]['commit']['author']['name'],
-                 utc_to_localtime(change['revisions'][change['current_revision']]['commit']['committer']['date'])
-                 ),
-                end='')
-            print(" | ", end='')
-
-            cherries = self.gerrit.get_change_cherry_pick(change, branch_to)
-            for cherry in cherries:
-                if cherry['branch'] != branch_to:
-                    continue
-                print('<a href="%s">%s</a> - **%s**/%s' %
-                      (self.gerrit.url_for_change(cherry['_number']),
-                       self.__md_escape(html.escape(cherry['subject'])),
-                       cherry['revisions'][cherry['current_revision']]['commit']['author']['name'],
-                       utc_to_localtime(cherry['revisions'][cherry['current_revision']]['commit']['committer']['date'])
-                       ),
-                      end='')
-                break
-
-            print(" |")
+            chunk.append(change)
+            if len(chunk) < chunk_size:
+                continue
+            with self.tracer.span('phase', 'fetch target', changes=len(chunk)):
+                cherries = self.agerrit.run(
+                    self.agerrit.get_changes_cherry_pick(chunk, branch_to))[0]
+            yield from zip(chunk, cherries)
+            chunk = []
+        if len(chunk) > 0:
+            with self.tracer.span('phase', 'fetch target', changes=len(chunk)):
+                cherries = self.agerrit.run(
+                    self.agerrit.get_changes_cherry_pick(chunk, branch_to))[0]
+            yield from zip(chunk, cherries)
 
     def cherry_pick_list(self,
                          project: str,
                          branch: str,
                          branch_to: str,
                          since: str = None,
-                         until: str = None):
+                         until: str = None,
+                         out = None,
+                         format: str = None):
         searches = ['project:%s' % project, 'is:merged']
 
         if since is None or since == '':
@@ -551,97 +2788,474 @@ class GerritTools:
         logging.debug('Branch graph 1: %s' % (graph_1))
         logging.debug('Branch graph 2: %s' % (graph_2))
 
-        # get src changes
+        # get src and target changes
         branches = [ ]
         for item in graph_1:
             branches.append(item['name'])
 
-        changes = self.gerrit.query_changes_between_branches(searches, [], branches, since, until)
-        logging.debug('Got %d commits from %s' % (len(changes), branches))
-
-        # get target changes
         target_branches = [ ]
         for item in graph_2:
             target_branches.append(item['name'])
 
-        target_changes = self.gerrit.query_changes_between_branches(searches, [], target_branches, since, until)
+        changes, target_changes = self.agerrit.run(
+            self.tracer.trace('phase', 'fetch source',
+                self.agerrit.query_changes_between_branches(
+                    searches, [self.gerrit.options('report')], branches, since, until)),
+            self.tracer.trace('phase', 'fetch target',
+                self.agerrit.query_changes_between_branches(
+                    searches, [self.gerrit.options('report')], target_branches, since, until)))
+        logging.debug('Got %d commits from %s' % (len(changes), branches))
         logging.debug('Got %d commits from %s' % (len(target_changes), target_branches))
 
-        print("# %s commits cherry pick list" % (project))
-        print("| %s | %s | " % (branch, branch_to))
-        print("|----|----|")
+        renderer = self.renderer(out, format)
+        renderer.begin('%s commits cherry pick list' % (project), [branch, branch_to])
 
-        end = len(changes)
-        for x in range(len(changes) - 1, -1, -1):
-            for y in range(len(target_changes) - 1, -1, -1):
-                if changes[x]['current_revision'] == target_changes[y]['current_revision']:
-                    end = x
-                    break
+        with self.tracer.span('phase', 'match'):
+            matcher = ChangeMatcher(target_changes)
+            end = matcher.find_end(changes)
 
         logging.debug('End: %d/%d' % (end, len(changes)))
 
-        for index in range(end):
-            change = changes[index]
-
-            print("| ", end="")
-            print(
-                '<a href="%s">%s</a> - **%s**/%s' %
-                (self.gerrit.url_for_change(change['_number']),
-                 self.__md_escape(html.escape(change['subject'])),
-                 change['revisions'][change['current_revision']]['commit']
-                 ['author']['name'], change['revisions']
-                 [change['current_revision']]['commit']['committer']['date']),
-                end='')
-            print(" | ", end='')
-
-            for cherry in target_changes:
-                if change['change_id'] != cherry['change_id'] or \
-                    change['branch'] == cherry['branch']:
-                    continue
-
-                if cherry['branch'] == branch_to:
-                    print('<a href="%s">%s</a> - **%s**/%s' %
-                      (self.gerrit.url_for_change(cherry['_number']),
-                       self.__md_escape(html.escape(cherry['subject'])),
-                       cherry['revisions'][cherry['current_revision']]['commit']['author']['name'],
-                       utc_to_localtime(cherry['revisions'][cherry['current_revision']]['commit']['committer']['date'])),
-                      end='')
-                else:
-                    print('<font color="red">**%s**</font></br> <a href="%s">%s</a> - **%s**/%s' %
-                      (cherry['branch'],
-                       self.gerrit.url_for_change(cherry['_number']),
-                       self.__md_escape(html.escape(cherry['subject'])),
-                       cherry['revisions'][cherry['current_revision']]['commit']['author']['name'],
-                       utc_to_localtime(cherry['revisions'][cherry['current_revision']]['commit']['committer']['date'])),
-                      end='')
+        if self.match_patches:
+            patch_ids = self.__patch_ids(changes, [None], [end], [matcher],
+                                         [target_changes])
+            matcher = ChangeMatcher(target_changes, patch_ids)
+
+        with self.tracer.span('phase', 'render', rows=end):
+            for index in range(end):
+                change = changes[index]
+                cherries = [
+                    (cherry, True, None if cherry.branch == branch_to else cherry.branch)
+                    for cherry in matcher.get_cherry_picks(change)
+                ]
+                renderer.row([[(change, False, None)], cherries])
+            renderer.end()
+
+        return end
+
+    def __patch_ids(self, changes: List, branches_to: List[str], ends: List[int],
+                    matchers: List[ChangeMatcher], histories: List[List]):
+        # Fingerprints of the source changes without a pick of the same
+        # Change-Id in at least one target(`branches_to`, before its end) and
+        # of the target changes that are not a pick of any source Change-Id,
+        # those are the only ones that can still match.
+        sources = [chg for index, chg in enumerate(changes[:max(ends, default=0)])
+                   if any(index < end and len(matcher.get_cherry_picks(chg, branch_to)) == 0
+                          for branch_to, end, matcher in zip(branches_to, ends, matchers))]
+        if len(sources) == 0:
+            return {}
+        change_ids = set([chg.change_id for chg in changes])
+        revisions = set([chg.revision for chg in changes])
+        targets = [chg for history in histories for chg in history
+                   if chg.change_id not in change_ids and chg.revision not in revisions]
+        if len(targets) == 0:
+            return {}
+        targets = list({chg.number: chg for chg in targets}.values())
+        with self.tracer.span('phase', 'fingerprint', changes=len(sources) + len(targets)):
+            patch_ids = self.agerrit.run(self.agerrit.get_patch_ids(sources + targets))[0]
+        return dict([(chg.revision, id) for chg, id in zip(sources + targets, patch_ids)
+                     if id is not None])
+
+    def cherry_pick_matrix(self,
+                           project: str,
+                           branch: str,
+                           branches_to: List[str],
+                           since: str = None,
+                           until: str = None,
+                           out = None,
+                           format: str = None):
+        searches = ['project:%s' % project, 'is:merged']
 
-            print(" |")
+        if since is None or since == '':
+            # the oldest fork point covers every target
+            since = None
+            for branch_to in branches_to:
+                fork_time = self.branches.find_since(branch, branch_to)
+                if fork_time is not None and (since is None or timestamp(fork_time) < timestamp(since)):
+                    since = fork_time
+        logging.debug('Since %s, until %s' %(since, until))
 
+        graphs = []
+        for name in [branch] + branches_to:
+            graphs.append([item['name'] for item in self.branches.get_graph(name)])
+        logging.debug('Branch graphs: %s' % (graphs))
+
+        histories = self.agerrit.run(
+            self.tracer.trace('phase', 'fetch',
+                self.agerrit.query_changes_between_graphs(
+                    searches, [self.gerrit.options('report')], graphs, since, until)))[0]
+        changes = histories[0]
+        logging.debug('Got %d commits from %s' % (len(changes), graphs[0]))
+
+        with self.tracer.span('phase', 'match'):
+            matchers = []
+            ends = []
+            for branch_to, target_changes in zip(branches_to, histories[1:]):
+                matcher = ChangeMatcher(target_changes)
+                matchers.append(matcher)
+                ends.append(matcher.find_end(changes))
+                logging.debug('End of %s: %d/%d' % (branch_to, ends[-1], len(changes)))
+        end = max(ends, default=0)
+
+        if self.match_patches:
+            patch_ids = self.__patch_ids(changes, branches_to, ends, matchers,
+                                         histories[1:])
+            matchers = [ChangeMatcher(target_changes, patch_ids)
+                        for target_changes in histories[1:]]
+
+        renderer = self.renderer(out, format)
+        renderer.begin('%s commits cherry pick matrix' % (project), [branch] + branches_to)
+
+        with self.tracer.span('phase', 'render', rows=end):
+            for index in range(end):
+                change = changes[index]
+                cells = [[(change, False, None)]]
+                for branch_to, matcher, end_to in zip(branches_to, matchers, ends):
+                    if index >= end_to:
+                        # already in the history of the target
+                        cells.append('merged')
+                        continue
+                    cells.append([(cherry, True, None)
+                                  for cherry in matcher.get_cherry_picks(change, branch_to)])
+                renderer.row(cells)
+            renderer.end()
+
+        return end
 
     def update_cache(self,
-                     project: str,
-                     branch: str,
+                     projects: List[str],
+                     branches: List[str],
                      since: str = None,
-                     until: str = None):
-        searches = [
-            'project:%s' % project,
-            'branch:%s' % branch, '-is:abandoned'
-        ]
+                     until: str = None,
+                     overlap: int = 600,
+                     serial: bool = False):
+        # `serial` syncs one branch after the other on the calling thread and
+        # leaves the workers of agerrit to the reports, e.g. those of serve
+        if '*' in branches:
+            branches = list(self.branches.config.keys())
+
+        items = []
+        for project in projects:
+            for branch in branches:
+                items.append((project, branch, since, until, overlap))
+        if serial:
+            counts = [self.__sync_branch(*item) for item in items]
+        else:
+            counts = self.agerrit.run(self.agerrit.map(self.__sync_branch, items))[0]
+        logging.debug('Got %d commits from %d branches' % (sum(counts), len(items)))
+
+    def __sync_branch(self,
+                      project: str,
+                      branch: str,
+                      since: str = None,
+                      until: str = None,
+                      overlap: int = 600):
+        # Abandoned changes are fetched too, so that changes which were open
+        # at the previous sync get their final status.
+        searches = ['project:%s' % project, 'branch:%s' % branch]
+
+        # The watermark only moves forward for incremental syncs, an explicit
+        # range is a one-off backfill.
+        incremental = (since is None or since == '') and \
+            (until is None or until == '')
+        watermark = self.cache.get_sync(project, branch)
+        if watermark is not None:
+            watermark = parse_time_ns(watermark)
         if since is None or since == '':
-            since = self.branches.get_since(branch)
-
-        info.debug('Since %s, until %s' %(since, until))
-        changes = self.gerrit.query_changes_between(searches, [], since, until)
-        info.debug('Got %d commits' % (len(changes)))
+            if watermark is not None:
+                since = time.strftime('%Y-%m-%d %H:%M:%S',
+                                      time.gmtime(watermark // NS - overlap))
+            else:
+                since = self.branches.get_since(branch)
+
+        logging.debug('%s %s: since %s, until %s' % (project, branch, since, until))
+        count = 0
+        updated = watermark
+        merged = []
+        for chg in self.gerrit.iter_changes_between(searches,
+                                                    [self.gerrit.options('cache')],
+                                                    since, until, refresh=True):
+            count += 1
+            if updated is None or chg.updated > updated:
+                updated = chg.updated
+            if self.match_patches and chg.status == 'MERGED':
+                merged.append(chg)
+        logging.debug('%s %s: got %d commits' % (project, branch, count))
+
+        if len(merged) > 0:
+            # index the merged revisions for the lookups of get_changes_cherry_pick
+            self.gerrit.get_patch_ids(merged)
+
+        if incremental and updated is not None and updated != watermark:
+            self.cache.set_sync(project, branch, gerrit_time(updated))
+        return count
+
+    def cherry_pick_batch(self,
+                          items: List[Dict[str, str]],
+                          out_dir: str,
+                          workers: int = 4):
+        # expand project globs into one report per project
+        reports = []
+        for item in items:
+            if re.search(r'[*?\[]', item['project']):
+                projects = self.gerrit.list_projects(item['project'])
+            else:
+                projects = [item['project']]
+            for project in projects:
+                reports.append(dict(item, project=project))
+
+        os.makedirs(out_dir, exist_ok=True)
+
+        def run(item):
+            name = '%s_%s_%s.%s' % (item['project'], item['branch'], item['branch_to'],
+                                    RENDERERS[self.format].ext)
+            path = os.path.join(out_dir, name.replace('/', '_'))
+            start = time.time()
+            try:
+                with open(path, 'w') as out:
+                    count = self.cherry_pick_list(item['project'], item['branch'],
+                                                  item['branch_to'],
+                                                  item.get('since', ''),
+                                                  item.get('until', ''), out)
+                return count, time.time() - start, path
+            except Exception as e:
+                logging.error('%s: %s' % (item['project'], e))
+                return None, time.time() - start, str(e)
+
+        with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+            results = list(executor.map(run, reports))
+
+        print("| project | branch | branch_to | commits | seconds | report |")
+        print("|----|----|----|----|----|----|")
+        for item, (count, elapsed, path) in zip(reports, results):
+            print("| %s | %s | %s | %s | %.1f | %s |" %
+                  (item['project'], item['branch'], item['branch_to'],
+                   'failed' if count is None else count, elapsed, path))
+
+    def serve(self,
+              bind: str,
+              port: int,
+              projects: List[str],
+              branches: List[str],
+              refresh: int = 300,
+              delay: float = 2.0):
+        # Answer report requests over http from this resident instance. The
+        # cached branches are held in a ChangeIndex, the cache of `projects`
+        # is refreshed in the background every `refresh` seconds and gerrit
+        # events posted to /events refresh the changes they name. A rendered
+        # report is kept until the next write to the cache.
+        state = {'generation': 0, 'refreshed': None, 'requests': 0, 'hits': 0}
+        reports = {}
+        lock = threading.Lock()
+        stop = threading.Event()
+        answer = self.__answer
+        gerrit = self.gerrit
+        index = ChangeIndex(self.cache)
+        gerrit.index = index
+
+        def invalidate(written):
+            with lock:
+                state['generation'] += 1
+                reports.clear()
+
+        self.cache.listeners.append(invalidate)
+        events = EventIngester(self.gerrit, delay)
+
+        def refresher():
+            while True:
+                if len(projects) > 0:
+                    start = time.time()
+                    try:
+                        self.update_cache(projects, branches, serial=True)
+                        logging.info('Refreshed %s in %.1fs' % (','.join(projects), time.time() - start))
+                    except Exception as e:
+                        logging.error('Refresh failed: %s' % (e))
+                with lock:
+                    state['refreshed'] = time.strftime('%Y-%m-%d %H:%M:%S')
+                if stop.wait(refresh):
+                    return
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def do_GET(self):
+                url = parse.urlsplit(self.path)
+                query = dict(parse.parse_qsl(url.query))
+                key = (url.path, tuple(sorted(query.items())))
+                with lock:
+                    state['requests'] += 1
+                    cached = reports.get(key) if refresh > 0 else None
+                    if cached is not None:
+                        state['hits'] += 1
+                if url.path == '/status':
+                    with lock:
+                        cached = (200, 'application/json', json.dumps(dict(
+                            state, cache_match=getattr(gerrit, 'cache_match', None),
+                            cache_miss=getattr(gerrit, 'cache_miss', None),
+                            index_loads=index.loads, index_hits=index.hits,
+                            index_updates=index.updates,
+                            events_received=events.received,
+                            events_ignored=events.ignored,
+                            events_refreshed=events.refreshed)).encode())
+                if cached is None:
+                    cached = answer(url.path, query)
+                    if cached[0] == 200 and refresh > 0:
+                        with lock:
+                            if len(reports) >= 256:
+                                reports.pop(next(iter(reports)))
+                            reports[key] = cached
+                self.reply(*cached)
+
+            def do_POST(self):
+                url = parse.urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if url.path != '/events':
+                    self.reply(404, 'text/plain', b'Not found\n')
+                    return
+                accepted = events.add_text(body.decode('utf-8', 'replace'))
+                self.reply(202, 'application/json',
+                           json.dumps({'accepted': accepted}).encode())
+
+            def reply(self, status: int, content_type: str, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', '%s; charset=utf-8' % (content_type))
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer((bind, port), Handler)
+        server.daemon_threads = True
+        if refresh > 0:
+            threading.Thread(target=refresher, name='refresh', daemon=True).start()
+        ingester = threading.Thread(target=events.run, args=(stop, ),
+                                    name='events', daemon=True)
+        ingester.start()
+        logging.info('Serving on http://%s:%d/' % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            events.stop(stop)
+            ingester.join()
+            server.server_close()
+
+    def ingest_events(self, path: str, delay: float = 2.0):
+        # Refresh the changes named by the events of a replay file, or of
+        # stdin for `-`, e.g. `ssh -p 29418 host gerrit stream-events`.
+        events = EventIngester(self.gerrit, delay)
+        stop = threading.Event()
+        ingester = threading.Thread(target=events.run, args=(stop, ),
+                                    name='events', daemon=True)
+        ingester.start()
+        try:
+            if path == '-':
+                for line in sys.stdin:
+                    events.add_text(line)
+            else:
+                with open(path, encoding='utf-8') as f:
+                    events.add_text(f.read())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            events.stop(stop)
+            ingester.join()
+        logging.info('Events: %d received, %d ignored, %d changes refreshed' %
+                     (events.received, events.ignored, events.refreshed))
+        return events.refreshed
+
+    def __answer(self, path: str, query: Dict[str, str]):
+        # (status, content type, body) of a report request
+        format = query.get('format', self.format)
+        if format not in RENDERERS:
+            return 400, 'text/plain', ('Unknown format: %s\n' % (format)).encode()
+        if path == '/cherry-pick-list':
+            names = ['project', 'branch', 'branch_to']
+        elif path == '/cherry-pick-matrix':
+            names = ['project', 'branch', 'branches_to']
+        else:
+            return 404, 'text/plain', b'Not found\n'
+        missing = [name for name in names if not query.get(name)]
+        if len(missing) > 0:
+            return 400, 'text/plain', ('Missing: %s\n' % (', '.join(missing))).encode()
+
+        out = io.StringIO()
+        try:
+            if path == '/cherry-pick-list':
+                self.cherry_pick_list(query['project'], query['branch'],
+                                      query['branch_to'], query.get('since', ''),
+                                      query.get('until', ''), out, format)
+            else:
+                if query['branches_to'] == '*':
+                    branches_to = [name for name in self.branches.config.keys()
+                                   if name != query['branch']]
+                else:
+                    branches_to = query['branches_to'].split(',')
+                self.cherry_pick_matrix(query['project'], query['branch'], branches_to,
+                                        query.get('since', ''),
+                                        query.get('until', ''), out, format)
+        except Exception as e:
+            logging.exception('%s?%s' % (path, parse.urlencode(query)))
+            return 500, 'text/plain', ('%s\n' % (e)).encode()
+        return 200, RENDERERS[format].content_type, out.getvalue().encode('utf-8')
 
     @staticmethod
     def __cherry_pick_list(tools, args):
         tools.cherry_pick_list(args.project, args.branch, args.branch_to,
                                args.since, args.until)
 
+    @staticmethod
+    def __cherry_pick_batch(tools, args):
+        items = []
+        if args.list:
+            with open(args.list) as f:
+                for item in json5.load(f):
+                    items.append(dict({
+                        'branch': args.branch,
+                        'branch_to': args.branch_to,
+                        'since': args.since,
+                        'until': args.until,
+                    }, **item))
+        for project in args.projects:
+            items.append({
+                'project': project,
+                'branch': args.branch,
+                'branch_to': args.branch_to,
+                'since': args.since,
+                'until': args.until,
+            })
+        for item in items:
+            if not item.get('branch') or not item.get('branch_to'):
+                raise RuntimeError('Missing branch or branch_to for %s' % (item['project']))
+        tools.cherry_pick_batch(items, args.out_dir, args.workers)
+
+    @staticmethod
+    def __cherry_pick_matrix(tools, args):
+        if args.branches_to == '*':
+            branches_to = [name for name in tools.branches.config.keys()
+                           if name != args.branch]
+        else:
+            branches_to = args.branches_to.split(',')
+        tools.cherry_pick_matrix(args.project, args.branch, branches_to,
+                                 args.since, args.until)
+
+    @staticmethod
+    def __serve(tools, args):
+        projects = args.project.split(',') if args.project else []
+        tools.serve(args.bind, args.port, projects, args.branch.split(','),
+                    args.refresh, args.delay)
+
+    @staticmethod
+    def __ingest_events(tools, args):
+        tools.ingest_events(args.file, args.delay)
+
     @staticmethod
     def __update_cache(tools, args):
-        tools.update_cache(args.project, args.branch, args.since, args.until)
+        tools.update_cache(args.project.split(','), args.branch.split(','),
+                           args.since, args.until, args.overlap)
 
     @staticmethod
     def usage(subparsers: argparse._SubParsersAction):
@@ -666,12 +3280,45 @@ class GerritTools:
             default='')
         cmd.set_defaults(func=GerritTools.__cherry_pick_list)
 
-        # update_cache
-        cmd = subparsers.add_parser('update-cache',
-                                    help='Update cache',
+        # cherry-pick-batch
+        cmd = subparsers.add_parser('cherry-pick-batch',
+                                    help='Get cherry-pick lists of many projects',
+                                    add_help=True)
+        cmd.add_argument('projects',
+                         nargs='*',
+                         help='Project names or globs(e.g. GRP260X/*)')
+        cmd.add_argument('-f', '--list',
+                         help='List of {project, branch, branch_to[, since, until]} in json5')
+        cmd.add_argument('-b', '--branch', help='Branch name')
+        cmd.add_argument('-t', '--branch_to', help='Cherry-pick target branch name')
+        cmd.add_argument(
+            '--since',
+            help=
+            'Change modified time after(format: 2006-01-02[ 15:04:05[.890])',
+            default='')
+        cmd.add_argument(
+            '--until',
+            help=
+            'Change modified time until(format: 2006-01-02[ 15:04:05[.890])',
+            default='')
+        cmd.add_argument('-d', '--out_dir',
+                         help='Directory of the reports(default: .)',
+                         default='.')
+        cmd.add_argument('-w', '--workers',
+                         type=int,
+                         help='Number of projects processed at once(default: 4)',
+                         default=4)
+        cmd.set_defaults(func=GerritTools.__cherry_pick_batch)
+
+        # cherry-pick-matrix
+        cmd = subparsers.add_parser('cherry-pick-matrix',
+                                    help='Get cherry-pick list of many target branches',
                                     add_help=True)
         cmd.add_argument('project', help='Project name')
         cmd.add_argument('branch', help='Branch name')
+        cmd.add_argument(
+            'branches_to',
+            help='Cherry-pick target branch names, separated by comma(* for all configured branches)')
         cmd.add_argument(
             'since',
             nargs='?',
@@ -684,8 +3331,75 @@ class GerritTools:
             help=
             'Change modified time until(format: 2006-01-02[ 15:04:05[.890])',
             default='')
+        cmd.set_defaults(func=GerritTools.__cherry_pick_matrix)
+
+        # update_cache
+        cmd = subparsers.add_parser('update-cache',
+                                    help='Update cache',
+                                    add_help=True)
+        cmd.add_argument('project', help='Project names, separated by comma')
+        cmd.add_argument(
+            'branch',
+            help='Branch names, separated by comma(* for all configured branches)')
+        cmd.add_argument(
+            'since',
+            nargs='?',
+            help=
+            'Change modified time after(format: 2006-01-02[ 15:04:05[.890], default: last sync)',
+            default='')
+        cmd.add_argument(
+            'until',
+            nargs='?',
+            help=
+            'Change modified time until(format: 2006-01-02[ 15:04:05[.890])',
+            default='')
+        cmd.add_argument(
+            '--overlap',
+            type=int,
+            help='Seconds re-fetched before the last sync time(default: 600)',
+            default=600)
         cmd.set_defaults(func=GerritTools.__update_cache)
 
+        # serve
+        cmd = subparsers.add_parser('serve',
+                                    help='Serve reports over http',
+                                    add_help=True)
+        cmd.add_argument('--bind',
+                         help='Address to listen on(default: 127.0.0.1)',
+                         default='127.0.0.1')
+        cmd.add_argument('-p', '--port',
+                         type=int,
+                         help='Port to listen on(default: 8080)',
+                         default=8080)
+        cmd.add_argument('--project',
+                         help='Project names refreshed in the background, separated by comma',
+                         default='')
+        cmd.add_argument(
+            '--branch',
+            help='Branch names refreshed in the background, separated by comma(default: *)',
+            default='*')
+        cmd.add_argument('--refresh',
+                         type=int,
+                         help='Seconds between refreshes, 0 to disable(default: 300)',
+                         default=300)
+        cmd.add_argument('--delay',
+                         type=float,
+                         help='Seconds a burst of posted events is coalesced(default: 2)',
+                         default=2.0)
+        cmd.set_defaults(func=GerritTools.__serve)
+
+        # ingest-events
+        cmd = subparsers.add_parser('ingest-events',
+                                    help='Refresh the changes named by gerrit events',
+                                    add_help=True)
+        cmd.add_argument('file',
+                         help='Event file(json lines or array), - to read stream-events from stdin')
+        cmd.add_argument('--delay',
+                         type=float,
+                         help='Seconds a burst of events is coalesced(default: 2)',
+                         default=2.0)
+        cmd.set_defaults(func=GerritTools.__ingest_events)
+
 
 def _get_conf_file(conf: str, filename: str, ext: List[str] = [ '.json5', '.json' ]):
     path = os.path.dirname(os.path.realpath(__file__))
@@ -738,7 +3452,53 @@ if __name__ == "__main__":
     parser.add_argument('--only_cache',
                         action='store_true',
                         help='Read data from cache only')
+    parser.add_argument('--pool_size',
+                        type=int,
+                        help='Number of persistent https connections(default: 4)')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        help='Number of concurrent gerrit requests(default: 4)')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        help='Number of changes resolved per query(default: 50)')
+    parser.add_argument('--page_size',
+                        type=int,
+                        help='Number of changes per query page(default: 500)')
+    parser.add_argument('--rate',
+                        type=float,
+                        help='Requests per second sent to gerrit, 0 for no limit(default: 0)')
+    parser.add_argument('--retries',
+                        type=int,
+                        help='Retries of a failed or throttled request(default: 3)')
+    parser.add_argument('--timeout',
+                        type=float,
+                        help='Seconds to wait for gerrit before a retry(default: 60)')
+    parser.add_argument('--cache_compress',
+                        action='store_true',
+                        help='Compress the change data stored in cache')
+    parser.add_argument('--patch_id',
+                        action='store_true',
+                        help='Also match cherry-picks by patch fingerprint when the Change-Id differs')
+    parser.add_argument('--coverage_trust',
+                        type=int,
+                        help='Hours before the last fetch that are fetched again(default: 0)')
+    parser.add_argument('--measure',
+                        action='store_true',
+                        help='Show requests and bytes transferred per option profile')
+    parser.add_argument('--metrics',
+                        help='Write per-request and per-phase metrics to a json file')
+    parser.add_argument('--trace',
+                        help='Write a chrome trace(chrome://tracing) to a json file')
+    parser.add_argument('--response_cache',
+                        help='Http response cache database')
+    parser.add_argument('--response_cache_size',
+                        type=int,
+                        help='Size limit of the http response cache in MB, 0 to disable(default: 256)')
     parser.add_argument('-o', '--out', help='Output file(default: stdout)')
+    parser.add_argument('-F', '--format',
+                        choices=list(RENDERERS.keys()),
+                        help='Report format(default: md)')
     parser.add_argument('-H', '--host', help='Gerrit host address')
     parser.add_argument('-U',
                         '--user',
@@ -769,6 +3529,13 @@ if __name__ == "__main__":
         'verbose': False,
         'verbose_http': False,
         'only_cache': False,
+        'pool_size': 4,
+        'jobs': 4,
+        'batch_size': 50,
+        'page_size': 500,
+        'cache_compress': False,
+        'coverage_trust': 0,
+        'response_cache_size': 256,
     }
     with open(get_conf_file(args.conf)) as f:
         conf = json5.load(f)
@@ -790,8 +3557,40 @@ if __name__ == "__main__":
         config['verbose'] = args.verbose
     if args.verbose_http:
         config['verbose_http'] = args.verbose_http
+    if args.cache:
+        config['cache'] = args.cache
     if args.only_cache:
         config['only_cache'] = args.only_cache
+    if args.pool_size:
+        config['pool_size'] = args.pool_size
+    if args.jobs:
+        config['jobs'] = args.jobs
+    if args.batch_size:
+        config['batch_size'] = args.batch_size
+    if args.page_size:
+        config['page_size'] = args.page_size
+    if args.cache_compress:
+        config['cache_compress'] = args.cache_compress
+    if args.coverage_trust is not None:
+        config['coverage_trust'] = args.coverage_trust
+    if args.patch_id:
+        config['patch_id'] = args.patch_id
+    if args.rate is not None:
+        config['rate'] = args.rate
+    if args.retries is not None:
+        config['retries'] = args.retries
+    if args.timeout:
+        config['timeout'] = args.timeout
+    if args.response_cache:
+        config['response_cache'] = args.response_cache
+    if args.format:
+        config['format'] = args.format
+    if args.metrics:
+        config['metrics'] = args.metrics
+    if args.trace:
+        config['trace'] = args.trace
+    if args.response_cache_size is not None:
+        config['response_cache_size'] = args.response_cache_size
 
     if 'host' not in config or config['host'] == "":
         print('Missing argument: host', file=sys.stderr)
@@ -810,9 +3609,50 @@ if __name__ == "__main__":
 
     gerrit_tools = GerritTools(config, branch_config)
     args.func(gerrit_tools, args)
+    gerrit_tools.agerrit.close()
+    gerrit_tools.cache.close()
 
     sys.stdout.flush()
 
     logging.debug(
         'Cache match/miss: %d/%d' %
         (gerrit_tools.gerrit.cache_match, gerrit_tools.gerrit.cache_miss))
+    if gerrit_tools.responses is not None:
+        logging.debug(
+            'Response cache hit/miss/304: %d/%d/%d' %
+            (gerrit_tools.responses.hits, gerrit_tools.responses.misses,
+             gerrit_tools.responses.not_modified))
+    for label, (count, size) in sorted(gerrit_tools.gerrit.transfer.items()):
+        logging.log(logging.INFO if args.measure else logging.DEBUG,
+                    'Transfer %s: %d requests, %d bytes' % (label, count, size))
+    logging.debug(
+        'Connections opened/handshakes avoided: %d/%d' %
+        (gerrit_tools.gerrit.pool.connects,
+         gerrit_tools.gerrit.pool.handshakes_avoided))
+    logging.log(logging.INFO if args.measure else logging.DEBUG,
+                'Retries/recovered/page shrinks: %d/%d/%d, throttled %.1fs' %
+                (gerrit_tools.gerrit.retried, gerrit_tools.gerrit.recovered,
+                 gerrit_tools.gerrit.page_shrinks,
+                 gerrit_tools.gerrit.limiter.waited))
+
+    if args.metrics:
+        counters = {
+            'cache_match': gerrit_tools.gerrit.cache_match,
+            'cache_miss': gerrit_tools.gerrit.cache_miss,
+            'connections': gerrit_tools.gerrit.pool.connects,
+            'handshakes_avoided': gerrit_tools.gerrit.pool.handshakes_avoided,
+            'retries': gerrit_tools.gerrit.retried,
+            'recovered': gerrit_tools.gerrit.recovered,
+            'page_shrinks': gerrit_tools.gerrit.page_shrinks,
+            'page_size': gerrit_tools.gerrit.page_limit,
+            'throttled_s': round(gerrit_tools.gerrit.limiter.waited, 3),
+            'transfer': {label: {'requests': count, 'bytes': size}
+                         for label, (count, size) in gerrit_tools.gerrit.transfer.items()},
+        }
+        if gerrit_tools.responses is not None:
+            counters.update(response_cache_hits=gerrit_tools.responses.hits,
+                            response_cache_misses=gerrit_tools.responses.misses,
+                            response_cache_not_modified=gerrit_tools.responses.not_modified)
+        gerrit_tools.tracer.write_summary(args.metrics, counters)
+    if args.trace:
+        gerrit_tools.tracer.write_chrome_trace(args.trace)
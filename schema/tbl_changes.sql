@@ -13,6 +13,8 @@ CREATE TABLE IF NOT EXISTS "tbl_changes" (
 	"author_date"	INTEGER DEFAULT NULL,
 	"committer"	TEXT DEFAULT NULL,
 	"committer_date"	INTEGER DEFAULT NULL,
+	"subject"	TEXT DEFAULT NULL,
+	"profile"	INTEGER DEFAULT NULL,
 	"data"	TEXT NOT NULL,
 	PRIMARY KEY("number")
 );
@@ -26,3 +28,10 @@ CREATE INDEX IF NOT EXISTS "tbl_changes_idx_project_branch_change_id" ON "tbl_ch
 CREATE INDEX IF NOT EXISTS "tbl_changes_idx_commit_id" ON "tbl_changes" (
 	"commit_id"
 );
+
+CREATE INDEX IF NOT EXISTS "tbl_changes_idx_project_branch_update_time" ON "tbl_changes" (
+	"project",
+	"branch",
+	"update_time",
+	"number"
+);
@@ -0,0 +1,9 @@
+
+CREATE TABLE IF NOT EXISTS "tbl_commits" (
+	"commit_id"	CHAR(42) NOT NULL,
+	"project"	VARCHAR(128) NOT NULL,
+	"number"	INTEGER NOT NULL,
+	"parent"	CHAR(42) DEFAULT NULL,
+	"parent2"	CHAR(42) DEFAULT NULL,
+	PRIMARY KEY("commit_id")
+) WITHOUT ROWID;
@@ -0,0 +1,15 @@
+
+CREATE TABLE IF NOT EXISTS "tbl_coverage" (
+	"project"	VARCHAR(128) NOT NULL,
+	"branch"	VARCHAR(128) NOT NULL,
+	"query"	TEXT NOT NULL,
+	"since"	INTEGER NOT NULL,
+	"until"	INTEGER NOT NULL,
+	"fetched"	INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS "tbl_coverage_idx_project_branch_query" ON "tbl_coverage" (
+	"project",
+	"branch",
+	"query"
+);
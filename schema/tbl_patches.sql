@@ -0,0 +1,12 @@
+
+CREATE TABLE IF NOT EXISTS "tbl_patches" (
+	"commit_id"	CHAR(42) NOT NULL,
+	"project"	VARCHAR(128) NOT NULL,
+	"patch_id"	CHAR(42) NOT NULL,
+	PRIMARY KEY("commit_id")
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS "tbl_patches_idx_project_patch_id" ON "tbl_patches" (
+	"project",
+	"patch_id"
+);
@@ -0,0 +1,15 @@
+
+CREATE TABLE IF NOT EXISTS "tbl_responses" (
+	"key"	CHAR(40) NOT NULL UNIQUE,
+	"url"	TEXT NOT NULL,
+	"etag"	TEXT DEFAULT NULL,
+	"last_modified"	TEXT DEFAULT NULL,
+	"size"	INTEGER NOT NULL,
+	"accessed"	INTEGER NOT NULL,
+	"body"	BLOB NOT NULL,
+	PRIMARY KEY("key")
+);
+
+CREATE INDEX IF NOT EXISTS "tbl_responses_idx_accessed" ON "tbl_responses" (
+	"accessed"
+);
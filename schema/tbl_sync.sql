@@ -0,0 +1,7 @@
+
+CREATE TABLE IF NOT EXISTS "tbl_sync" (
+	"project"	VARCHAR(128) NOT NULL,
+	"branch"	VARCHAR(128) NOT NULL,
+	"updated"	CHAR(32) NOT NULL,
+	PRIMARY KEY("project", "branch")
+);
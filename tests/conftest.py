@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import benchmark
+import gerrit
+
+BRANCHES = {
+    'master': {'parent': '', 'create_time': '2020-01-01 00:00:00'},
+}
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    return benchmark.make_certificate(str(tmp_path_factory.mktemp('cert')))
+
+
+@pytest.fixture
+def serve(certificate):
+    # start a stub gerrit for a synthetic history, stopped after the test
+    stubs = []
+
+    def start(history, **kwargs):
+        stub = benchmark.StubGerrit(history, *certificate, **kwargs).start()
+        stubs.append(stub)
+        return stub
+
+    yield start
+    for stub in stubs:
+        stub.stop()
+
+
+@pytest.fixture
+def tools(tmp_path):
+    # GerritTools on a stub gerrit, with its own cache files
+    opened = []
+
+    def make(stub, branches=BRANCHES, **config):
+        config = dict({'host': stub.host, 'user': 'test', 'passwd': 'test',
+                       'insecure': True, 'verbose_http': False,
+                       'cache': str(tmp_path / 'cache.db'),
+                       'response_cache': str(tmp_path / 'response.db'),
+                       'retries': 1, 'timeout': 10}, **config)
+        gerrit_tools = gerrit.GerritTools(config, branches)
+        opened.append(gerrit_tools)
+        return gerrit_tools
+
+    yield make
+    for gerrit_tools in opened:
+        gerrit_tools.cache.close()
@@ -0,0 +1,311 @@
+import calendar
+import datetime
+import io
+import json
+import socket
+import time
+
+import pytest
+from dateutil import parser as DateParser
+
+import benchmark
+import gerrit
+
+from conftest import BRANCHES
+
+
+def history(changes: int = 300, abandon_ratio: float = 0):
+    return benchmark.SyntheticHistory(BRANCHES, changes, pick_ratio=0,
+                                      abandon_ratio=abandon_ratio)
+
+
+def test_dropped_page_is_resumed(serve, tools):
+    # the connection of the first page drops in the middle of change 151
+    stub = serve(history(300))
+    dropped = []
+
+    def drop(path, body):
+        if '/changes/?' not in path or len(dropped) > 0:
+            return None
+        dropped.append(path)
+        offset = 0
+        for _ in range(151):
+            offset = body.index(b'{"id": ', offset + 1)
+        return offset + 10
+
+    stub.drop = drop
+    gerrit_tools = tools(stub)
+    search = ['project:bench/p0', 'branch:master', 'is:merged']
+    changes = list(gerrit_tools.gerrit.iter_changes_between(search, []))
+
+    assert len(dropped) == 1
+    assert len(changes) == 300
+    assert len({chg.number for chg in changes}) == 300
+    cache = gerrit_tools.cache
+    assert len(list(cache.get_changes_between('bench/p0', 'master', '', 0, 2 ** 40))) == 300
+    # a resumed window is not trusted, the next query fetches it again
+    assert cache.get_coverage('bench/p0', 'master', 'is:merged') == []
+    stub.reset()
+    assert len(list(gerrit_tools.gerrit.iter_changes_between(search, []))) == 300
+    assert stub.requests > 0
+    assert len(cache.get_coverage('bench/p0', 'master', 'is:merged')) == 1
+
+
+def test_gaps_stream_newest_first(serve, tools):
+    stub = serve(history(300))
+    gerrit_tools = tools(stub)
+    search = ['project:bench/p0', 'branch:master', 'is:merged']
+    middle = list(gerrit_tools.gerrit.iter_changes_between(
+        search, [], '2020-05-01 00:00:00', '2020-09-01 00:00:00'))
+    assert 0 < len(middle) < 300
+
+    # a gap before and after the covered middle, the first change comes
+    # before the older gap is asked for
+    paths = []
+    handle = stub.handle
+
+    def spy(path, headers):
+        paths.append(path)
+        return handle(path, headers)
+
+    stub.handle = spy
+    changes = gerrit_tools.gerrit.iter_changes_between(search, [])
+    first = next(changes)
+    assert len(paths) == 1
+    changes = [first] + list(changes)
+    assert len(paths) == 2
+    assert len(changes) == 300
+    assert [chg.number for chg in changes] == \
+        [chg.number for chg in sorted(changes, key=lambda chg: -chg.updated)]
+
+
+def test_change_index_follows_cache(serve, tools):
+    stub = serve(history(200, abandon_ratio=0.2))
+    gerrit_tools = tools(stub)
+    cache = gerrit_tools.cache
+    list(gerrit_tools.gerrit.iter_changes_between(['project:bench/p0', 'branch:master'], []))
+    index = gerrit.ChangeIndex(cache)
+    since, until = 1585000000, 1600000000
+    for query in gerrit.ChangeIndex.FILTERS:
+        expected = list(cache.get_changes_between('bench/p0', 'master', query, since, until))
+        changes = index.get_changes_between('bench/p0', 'master', query, since, until)
+        assert len(changes) > 0
+        assert [chg.number for chg in changes] == [chg.number for chg in expected]
+
+    # written to the cache, the index has it without reading the branch again
+    updated = (until - 60) * gerrit.NS
+    cache.update_list([gerrit.Change(100000, 'bench/p0', 'master', 'I%040x' % (100000),
+                                     'New change', 'MERGED', updated,
+                                     revision='%040x' % (100000), data={})])
+    changes = index.get_changes_between('bench/p0', 'master', 'is:merged', since, until)
+    assert changes[0].number == 100000
+    assert index.loads == 1
+    assert index.updates == 1
+
+
+def test_conditional_get_revalidates(serve, tmp_path):
+    hist = history(20)
+    stub = serve(hist)
+    responses = gerrit.ResponseCache(str(tmp_path / 'response.db'))
+    client = gerrit.Gerrit(stub.host, 'test', 'test', responses=responses)
+    key = responses.key('test', 'https://%s/a/changes/7' % (stub.host))
+    chg = hist.changes[6]
+
+    # a 200 stores the body with its ETag
+    assert client.get_change('7').number == 7
+    etag = '"7-%d"' % (chg[hist.UPDATED])
+    assert responses.get(key)[0] == etag
+
+    # a 304 is answered from the stored body
+    before = client.get_change('7')
+    assert responses.not_modified == 1
+    assert before.updated == gerrit.parse_time_ns(benchmark.gerrit_time(chg[hist.UPDATED]))
+
+    # a changed ETag replaces it
+    hist.changes[6] = chg[:hist.UPDATED] + (chg[hist.UPDATED] + 60, ) + chg[hist.UPDATED + 1:]
+    after = client.get_change('7')
+    assert responses.not_modified == 1
+    assert after.updated == before.updated + 60 * gerrit.NS
+    assert responses.get(key)[0] == '"7-%d"' % (chg[hist.UPDATED] + 60)
+    client.pool.close()
+    responses.conn.close()
+
+
+def test_timeouts_are_retried_once(serve):
+    # get() retries the request, the pages do not retry it again
+    stub = serve(history(20), latency=0.5)
+    paths = []
+    handle = stub.handle
+
+    def spy(path, headers):
+        paths.append(path)
+        return handle(path, headers)
+
+    stub.handle = spy
+    client = gerrit.Gerrit(stub.host, 'test', 'test', retries=2, timeout=0.1)
+    client.BACKOFF = 0.01
+    with pytest.raises(socket.timeout):
+        list(client.iter_changes_between(['project:bench/p0'], []))
+    time.sleep(1)
+    assert len(paths) == 3
+    assert client.retried == 2
+    client.pool.close()
+
+
+def test_cached_range_chunks(tmp_path):
+    # chunks end in the middle of changes updated in the same second
+    cache = gerrit.GerritCache(str(tmp_path / 'cache.db'))
+    cache.update_list([gerrit.Change(number, 'p', 'master', 'I%040x' % (number), 'Change',
+                                     'MERGED' if number % 5 else 'ABANDONED',
+                                     (1600000000 + number // 4) * gerrit.NS,
+                                     revision='%040x' % (number), data={})
+                       for number in range(1, 101)])
+    for query in ['', 'is:merged']:
+        expected = [(chg.updated, chg.number) for chg in
+                    cache.get_changes_between('p', 'master', query, 1600000002, 1600000020)]
+        assert len(expected) > 0
+        assert expected == sorted(expected, reverse=True)
+        for size in [1, 3, 4, 7]:
+            assert [(chg.updated, chg.number) for chg in cache.get_changes_between(
+                'p', 'master', query, 1600000002, 1600000020, size)] == expected
+
+    plan = cache.conn.execute(
+        '''EXPLAIN QUERY PLAN SELECT number from tbl_changes where project = ?
+           and branch = ? and update_time >= ? and update_time <= ?
+           ORDER BY update_time DESC, number DESC''', ('p', 'master', 0, 1)).fetchall()
+    assert 'tbl_changes_idx_project_branch_update_time' in plan[0][-1]
+    cache.close()
+
+
+def test_reachable_through_both_parents(tmp_path):
+    # master: 1 <- 2 <- 4(merge of 3), feature: 3 forked from 1; 5 elsewhere
+    cache = gerrit.GerritCache(str(tmp_path / 'cache.db'))
+    commits = {number: '%040x' % (number) for number in range(1, 6)}
+    parents = {1: (), 2: (commits[1], ), 3: (commits[1], ),
+               4: (commits[2], commits[3]), 5: ()}
+    branches = {1: 'master', 2: 'master', 3: 'feature', 4: 'master', 5: 'other'}
+    cache.update_list([gerrit.Change(number, 'p', branches[number], 'I%040x' % (number),
+                                     'Change', 'MERGED', (1600000000 + number) * gerrit.NS,
+                                     revision=commits[number], parents=parents[number],
+                                     data={})
+                       for number in commits])
+    client = gerrit.GerritCached(cache, 'localhost', 'test', 'test')
+    assert cache.get_branch_head('p', 'master') == commits[4]
+    assert client.is_reachable(commits[3], 'p', 'master') is True
+    assert client.is_reachable(commits[1], 'p', 'master') is True
+    assert client.is_reachable(commits[4], 'p', 'feature') is False
+    assert client.is_reachable(commits[5], 'p', 'master') is False
+    assert client.is_reachable(commits[1], 'p', 'missing') is None
+    client.pool.close()
+    cache.close()
+
+
+def test_change_data_upgrades_lazily(serve, tools):
+    # rows of a report carry no files, asking for them fetches the change
+    stub = serve(history(20))
+    gerrit_tools = tools(stub, cache_compress=True)
+    client = gerrit_tools.gerrit
+    client.query_changes(['change:5'], [client.options('report')])
+    row = gerrit_tools.cache.conn.execute('SELECT data from tbl_changes where number = 5')
+    assert isinstance(row.fetchone()[0], bytes)
+    assert gerrit_tools.cache.get_raw(5)['_number'] == 5
+    assert gerrit_tools.cache.get_raw(5, client.profile_mask('cache')) is None
+
+    stub.reset()
+    data = client.get_change_data(5, 'cache')
+    assert stub.requests == 1
+    assert 'files' in data['revisions'][data['current_revision']]
+    assert client.get_change_data(5, 'report') == data
+    assert stub.requests == 1
+
+
+def test_replayed_events_refresh_changes(serve, tools, tmp_path, monkeypatch):
+    # a replay of merged and abandoned events refreshes the open changes
+    synthetic = history(20)
+    for number in (5, 6):
+        synthetic.changes[number - 1] = \
+            synthetic.changes[number - 1][:synthetic.STATUS] + ('NEW', )
+    stub = serve(synthetic)
+    gerrit_tools = tools(stub)
+    client = gerrit_tools.gerrit
+    client.query_changes(['change:5 OR change:6'], [client.options('cache')])
+    assert gerrit_tools.cache.get_by_number(5).status == 'NEW'
+
+    for number, status in ((5, 'MERGED'), (6, 'ABANDONED')):
+        synthetic.changes[number - 1] = \
+            synthetic.changes[number - 1][:synthetic.STATUS] + (status, )
+    path = tmp_path / 'events.json'
+    path.write_text('\n'.join([
+        '{"type": "change-merged", "change": {"number": 5}}',
+        '{"type": "comment-added", "change": {"number": 7}}',
+        '{"type": "change-abandoned", "change": {"number": 6}}',
+        'not json',
+    ]))
+    ingesters = []
+
+    class Ingester(gerrit.EventIngester):
+        def __init__(self, *args):
+            super().__init__(*args)
+            ingesters.append(self)
+
+    monkeypatch.setattr(gerrit, 'EventIngester', Ingester)
+    assert gerrit_tools.ingest_events(str(path), delay=0) == 2
+
+    events = ingesters[0]
+    assert (events.received, events.ignored, events.refreshed) == (2, 2, 2)
+    assert gerrit_tools.cache.get_by_number(5).status == 'MERGED'
+    assert gerrit_tools.cache.get_by_number(6).status == 'ABANDONED'
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 8))
+def test_iter_json_small_chunks(chunk_size):
+    # values cut at any byte decode the same as the whole body
+    values = [{'subject': "keep )]}' in text", 'files': ['a', 'b']},
+              1234567890123, -12.5e3, 'caf\u00e9 \u2713', [], None, True]
+    body = json.dumps(values, ensure_ascii=False).encode('utf-8')
+    assert list(gerrit.iter_json(io.BytesIO(gerrit.XSSI_PREFIX + body).read,
+                                 chunk_size)) == values
+    assert list(gerrit.iter_json(io.BytesIO(body).read, chunk_size)) == values
+    assert list(gerrit.iter_json(io.BytesIO(b'  [ ] ').read, chunk_size)) == []
+    assert list(gerrit.iter_json(io.BytesIO(gerrit.XSSI_PREFIX + b'{"a": 1}').read,
+                                 chunk_size)) == [{'a': 1}]
+    assert list(gerrit.iter_json(io.BytesIO(b'")]}\'\\n"').read,
+                                 chunk_size)) == [")]}'\n"]
+    assert list(gerrit.iter_json(io.BytesIO(b'9876543210').read,
+                                 chunk_size)) == [9876543210]
+    with pytest.raises(ValueError):
+        list(gerrit.iter_json(io.BytesIO(body[:-1]).read, chunk_size))
+
+
+def dateutil_ns(text: str, keep_zone: bool = True):
+    # what dateutil makes of `text`, plus the digits past microseconds
+    tm = DateParser.parse(text)
+    if tm.tzinfo is None or not keep_zone:
+        tm = tm.replace(tzinfo=datetime.timezone.utc)
+    ns = calendar.timegm(tm.utctimetuple()) * gerrit.NS + tm.microsecond * 1000
+    if len(text) > 26 and text[19] == '.' and text[20:].isdigit():
+        ns += int(text[26:29].ljust(3, '0'))
+    return ns
+
+
+@pytest.mark.parametrize('text, keep_zone', [
+    ('2021-03-04 05:06:07.123456789', True),
+    ('2021-03-04 05:06:07.5', True),
+    ('1999-12-31 23:59:59', True),
+    ('2021-03-04 05:06:07+02:00', True),
+    ('2021-03-04T05:06:07.250-0530', True),
+    ('2021-03-04 05:06:07+02:00', False),
+    ('2021-03-04 05:06:07.123456789', False),
+])
+def test_parse_time_ns_matches_dateutil(text, keep_zone):
+    # the positional fast path agrees with the dateutil fallback
+    assert gerrit.parse_time_ns(text, keep_zone) == dateutil_ns(text, keep_zone)
+
+
+def test_parse_time_ns_zones():
+    # a zone moves the time to UTC unless `keep_zone` is off
+    utc = gerrit.parse_time_ns('2021-03-04 05:06:07')
+    assert gerrit.parse_time_ns('2021-03-04 07:06:07+02:00') == utc
+    assert gerrit.parse_time_ns('2021-03-04 05:06:07+02:00', False) == utc
+    assert gerrit.gerrit_time(gerrit.parse_time_ns('2021-03-04 05:06:07.000000042')) == \
+        '2021-03-04 05:06:07.000000042'
@@ -0,0 +1,88 @@
+import concurrent.futures
+import io
+import json
+import threading
+import time
+
+import benchmark
+
+from conftest import BRANCHES
+
+
+def test_cherry_pick_list_to_unknown_branch(serve, tools):
+    # a target branch missing from the branch config has no changes
+    history = benchmark.SyntheticHistory(BRANCHES, 50, pick_ratio=0, abandon_ratio=0)
+    gerrit_tools = tools(serve(history))
+    out = io.StringIO()
+    count = gerrit_tools.cherry_pick_list('bench/p0', 'master', 'NOT_CONFIGURED', out=out)
+    assert count == 50
+    assert 'NOT_CONFIGURED' in out.getvalue()
+
+
+def test_cherry_pick_matrix_patch_id(serve, tools):
+    # picked into FP2 with the same Change-Id and into FP3 with another one
+    branches = {
+        'master': {'parent': '', 'create_time': '2020-01-01 00:00:00'},
+        'FP2': {'parent': 'master', 'create_time': '2020-03-01 00:00:00'},
+        'FP3': {'parent': 'master', 'create_time': '2020-03-01 00:00:00'},
+    }
+    history = benchmark.SyntheticHistory(branches, 400, pick_ratio=0.9,
+                                         abandon_ratio=0, span_days=60)
+    origin = None
+    for number, picks in sorted(history.by_origin.items()):
+        picked = {chg[history.BRANCH]: chg[history.NUMBER] for chg in picks}
+        if set(picked) == {'master', 'FP2', 'FP3'}:
+            origin = number
+            break
+    assert origin is not None
+    history.repick(picked['FP3'], 1000000)
+
+    gerrit_tools = tools(serve(history), branches, patch_id=True)
+    out = io.StringIO()
+    gerrit_tools.cherry_pick_matrix('bench/p0', 'master', ['FP2', 'FP3'],
+                                    out=out, format='json')
+    rows = {row[0][0]['number']: row for row in json.loads(out.getvalue())['rows']}
+    assert [chg['number'] for chg in rows[origin][1]] == [picked['FP2']]
+    assert [chg['number'] for chg in rows[origin][2]] == [picked['FP3']]
+
+
+def test_concurrent_reports_share_branch_queries(serve, tools):
+    # reports of several threads, e.g. of serve, each with its event loop
+    branches = {
+        'master': {'parent': '', 'create_time': '2020-01-01 00:00:00'},
+        'FP2': {'parent': 'master', 'create_time': '2020-03-01 00:00:00'},
+        'FP3': {'parent': 'master', 'create_time': '2020-03-01 00:00:00'},
+    }
+    history = benchmark.SyntheticHistory(branches, 3000, pick_ratio=0.5,
+                                         abandon_ratio=0, span_days=60)
+    gerrit_tools = tools(serve(history, latency=0.05, page_limit=100), branches)
+
+    def report(branch_to):
+        out = io.StringIO()
+        return gerrit_tools.cherry_pick_list('bench/p0', 'master', branch_to, out=out)
+
+    with concurrent.futures.ThreadPoolExecutor(3) as executor:
+        counts = list(executor.map(report, ['FP2', 'FP3', 'FP2']))
+    assert counts[0] == counts[2] > 0
+    assert counts[1] > 0
+    assert counts == [report('FP2'), report('FP3'), report('FP2')]
+
+
+def test_serial_refresh_leaves_workers_to_reports(serve, tools):
+    history = benchmark.SyntheticHistory(BRANCHES, 1000, pick_ratio=0, abandon_ratio=0)
+    gerrit_tools = tools(serve(history, latency=0.05, page_limit=50), jobs=1)
+    done = {}
+
+    def refresh():
+        gerrit_tools.update_cache(['bench/p0'], ['*'], serial=True)
+        done['refresh'] = time.monotonic()
+
+    refresher = threading.Thread(target=refresh)
+    refresher.start()
+    time.sleep(0.2)
+    out = io.StringIO()
+    gerrit_tools.cherry_pick_list('bench/p0', 'master', 'NOT_CONFIGURED',
+                                  '2020-12-20 00:00:00', out=out)
+    done['report'] = time.monotonic()
+    refresher.join()
+    assert done['report'] < done['refresh']